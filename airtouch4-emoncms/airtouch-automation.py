@@ -1,12 +1,15 @@
+import os
+import sys
 import asyncio
-import json
 import requests
 import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from emonlib.emoncms import EmonCMS
+from emonlib.scheduler import Ticker
 
 from airtouch4pyapi import AirTouch, AirTouchStatus
 
 EMONCMS_API_KEY = "YOUR EMONCMS API KEY"
-EMONCMS_HEADERS = {"Authorization": f"Bearer {EMONCMS_API_KEY}"}
 EMONCMS_SERVER_IP = "EMONCMS IP"
 INTERVAL = 5
 AIRTOUCH_IP = "AIRTOUCH4 IP"
@@ -39,6 +42,7 @@ AWAY_MODE_FEED_ID = 513
 FAN_MODE = "Fan"
 
 session = requests.Session()
+emoncms = EmonCMS(f"http://{EMONCMS_SERVER_IP}", EMONCMS_API_KEY)
 
 def map_mode(mode, reverse=False):
 	if reverse:
@@ -48,33 +52,27 @@ def map_mode(mode, reverse=False):
 	else:
 		return MODE_MAP.get(mode)
 
-def post_to_emoncms(node_name, data):
-	url = f"http://{EMONCMS_SERVER_IP}/input/post.json?node={node_name}&fulljson={data}"
-	response = session.post(url, headers=EMONCMS_HEADERS)
-	response.raise_for_status()
-	if response.status_code != 200:
-		print(f"Error posting data to EmonCMS: {response.content}")
-
-def get_feed_value(feed_id):
-	url = f"http://{EMONCMS_SERVER_IP}/feed/value.json?id={feed_id}"
-	response = session.get(url, headers=EMONCMS_HEADERS)
-	response.raise_for_status()
-	return int(response.text)
-
-def get_state_changes():
-	spike1 = get_feed_value(PRICE_SPIKE_FEED_ID)
-	spike2 = get_feed_value(AC_MODE_KNOWN_SPIKE_FEED_ID)
-	
-	away1 = get_feed_value(AWAY_MODE_FEED_ID)
-	away2 = get_feed_value(AC_POWER_KNOWN_AWAY_FEED_ID)
+async def post_to_emoncms(node_name, data):
+	await emoncms.post(node_name, data)
+
+async def get_feed_value(feed_id):
+	return int(await emoncms.get_feed_value(feed_id))
+
+async def get_state_changes():
+	spike1, spike2, away1, away2 = await asyncio.gather(
+		get_feed_value(PRICE_SPIKE_FEED_ID),
+		get_feed_value(AC_MODE_KNOWN_SPIKE_FEED_ID),
+		get_feed_value(AWAY_MODE_FEED_ID),
+		get_feed_value(AC_POWER_KNOWN_AWAY_FEED_ID),
+	)
 	if spike1 != spike2:
 		return "spike"
 	if away1 != away2:
 		return "away"
 	return False
 
-def away_mode():
-	if get_feed_value(AWAY_MODE_FEED_ID) == 1:
+async def away_mode():
+	if await get_feed_value(AWAY_MODE_FEED_ID) == 1:
 		return True
 	return False
 
@@ -92,9 +90,9 @@ def send_notification(str):
     if response.status_code != 200:
         print(f"Error sending notification: {response.content}")
         
-def set_known_modes():
-	post_to_emoncms("AUTOMATION", json.dumps({"ac-mode-known-spike": get_feed_value(PRICE_SPIKE_FEED_ID)}))
-	post_to_emoncms("AUTOMATION", json.dumps({"ac-power-known-away": get_feed_value(AWAY_MODE_FEED_ID)}))
+async def set_known_modes():
+	known_spike, known_away = await asyncio.gather(get_feed_value(PRICE_SPIKE_FEED_ID), get_feed_value(AWAY_MODE_FEED_ID))
+	await post_to_emoncms("AUTOMATION", {"ac-mode-known-spike": known_spike, "ac-power-known-away": known_away})
 
 async def update_airtouch_mode(mode):
 	#ac = at.GetAcs()[0]
@@ -149,29 +147,29 @@ async def get_airtouch_currentmode():
 
 async def update_info_and_display():
 	try:
-		state_changes = get_state_changes()
-		automation_feed_value = get_feed_value(AC_AUTOMATION_FEED_ID)
+		state_changes = await get_state_changes()
+		automation_feed_value = await get_feed_value(AC_AUTOMATION_FEED_ID)
 		if automation_feed_value == 0:
 			print("Aircon automation disabled. Exiting.")
 			return
 
-		pre_spike_mode_str = str(map_mode(get_feed_value(AC_MODE_PRE_SPIKE_FEED_ID), reverse=True))
-		spike_value = get_feed_value(PRICE_SPIKE_FEED_ID)
+		pre_spike_mode_str = str(map_mode(await get_feed_value(AC_MODE_PRE_SPIKE_FEED_ID), reverse=True))
+		spike_value = await get_feed_value(PRICE_SPIKE_FEED_ID)
 	
-		if away_mode() == True:
+		if await away_mode() == True:
 			#if get_feed_value(AC_POWER_STATE_FEED_ID) == 1:
 			if await get_airtouch_power() == 1:
-				post_to_emoncms("AUTOMATION", json.dumps({"ac-power-pre-away": 1}))
+				await post_to_emoncms("AUTOMATION", {"ac-power-pre-away": 1})
 				print(f"Away mode is active. turning off AC")
 				send_notification("Away mode is active. turning off AC")
 				await set_airtouch_power("off")
-				set_known_modes()
+				await set_known_modes()
 				return
 
-		state_changes = get_state_changes()
+		state_changes = await get_state_changes()
 
 		if state_changes == "away":
-			power_before_away = get_feed_value(AC_POWER_PRE_AWAY_FEED_ID)
+			power_before_away = await get_feed_value(AC_POWER_PRE_AWAY_FEED_ID)
 			if power_before_away == 1:
 				if await get_airtouch_power() != power_before_away:
 					print(f"Away mode disabled. turning on AC")
@@ -184,7 +182,7 @@ async def update_info_and_display():
 			if spike_value != 0 and current_mode != FAN_MODE:
 				print("Spike detected. Switching to fan mode.")
 				previous_mode = map_mode(current_mode)
-				post_to_emoncms("AUTOMATION", json.dumps({"ac-mode-pre-spike": previous_mode}))
+				await post_to_emoncms("AUTOMATION", {"ac-mode-pre-spike": previous_mode})
 				send_notification("Spike detected. Switching to fan mode.")
 				await update_airtouch_mode(FAN_MODE)
 			elif spike_value == 0 and current_mode == FAN_MODE:
@@ -192,7 +190,7 @@ async def update_info_and_display():
 				send_notification("Spike is over. Switching back to original mode.")
 				await update_airtouch_mode(pre_spike_mode_str)
 								
-		set_known_modes()
+		await set_known_modes()
 								
 	except Exception as e:
 		print(f"Error updating info: {e}")
@@ -200,11 +198,11 @@ async def update_info_and_display():
 
 async def main():
 	print("Starting up...")
-	await update_info_and_display()
-	print("Running.")
-	while True:
-		await asyncio.sleep(INTERVAL)
+	async with emoncms:
 		await update_info_and_display()
+		print("Running.")
+		async for tick in Ticker(INTERVAL):
+			await update_info_and_display()
 
 if __name__ == "__main__":
 	asyncio.run(main())
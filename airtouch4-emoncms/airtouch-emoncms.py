@@ -1,18 +1,42 @@
+import os
+import sys
 import asyncio
-import json
-import requests
 import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from emonlib.emoncms import EmonCMS
+from emonlib.spool import Spool
+from emonlib.scheduler import Ticker
+from emonlib.health import HealthReporter
+from emonlib.metrics import Metrics
+from emonlib.sinks import Outputs, InfluxSink, MQTTSink
+from emonlib.clock import wall_time
 
 from airtouch4pyapi import AirTouch, AirTouchStatus
 
 EMONCMS_API_KEY = "YOUR-EMONCMS-API-KEY"
-EMONCMS_HEADERS = {"Authorization": f"Bearer {EMONCMS_API_KEY}"}
 EMONCMS_SERVER_IP = "EMONCMS IP OR FQDN"
 EMONCMS_UPDATE_INTERVAL = 60
 AIRTOUCH_IP = "AIRTOUCH4-IP"
 HEALTHCHECKS_IO_URL = "HEALTHCHECK-URL"
-
-session = requests.Session()
+HEALTH_WINDOW = 60 #SECONDS, AT MOST ONE PING AND ONE LOG PER WINDOW
+SPOOL_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".spool.db"
+METRICS_PORT = 9105 #PROMETHEUS TEXT ON http://127.0.0.1:9105/, None DISABLES
+METRICS_FILE = None #OR A PATH THE SAME TEXT IS WRITTEN TO EVERY 15 SECONDS
+INFLUXDB_URL = None #E.G. "http://localhost:8086" TO WRITE STRAIGHT INTO INFLUXDB AS WELL
+INFLUXDB_DATABASE = "telegraf"
+INFLUXDB_TOPIC_PREFIX = "" #IN FRONT OF <NODE>/<KEY>, E.G. "emon/" IF TELEGRAF'S TOPICS CARRY THE EMONCMS MQTT BASE TOPIC
+MQTT_HOST = None #E.G. "localhost" TO PUBLISH emon/<node> JSON AS WELL, NEEDS paho-mqtt
+
+metrics = Metrics("airtouch", port=METRICS_PORT, path=METRICS_FILE)
+emoncms = EmonCMS(f"http://{EMONCMS_SERVER_IP}", EMONCMS_API_KEY, spool=Spool(SPOOL_PATH), metrics=metrics)
+
+sinks = [emoncms]
+if INFLUXDB_URL:
+	sinks.append(InfluxSink(INFLUXDB_URL, INFLUXDB_DATABASE, topic_prefix=INFLUXDB_TOPIC_PREFIX))
+if MQTT_HOST:
+	sinks.append(MQTTSink(MQTT_HOST))
+outputs = Outputs(sinks, on_error=lambda name, e, rows: print(f"Error posting data to {name}: {e}"))
+health = HealthReporter(HEALTHCHECKS_IO_URL, window=HEALTH_WINDOW, metrics=metrics)
 
 FAN_SPEED_MAP = {
 	"Auto": 0,
@@ -45,26 +69,15 @@ def map_mode(mode):
 def map_power_state(power_state):
 	return POWER_STATE_MAP.get(power_state)
 
-def post_to_emoncms(node_name, data):
-	url = f"http://{EMONCMS_SERVER_IP}/input/post.json?node={node_name}&fulljson={data}"
-	response = session.post(url, headers=EMONCMS_HEADERS)
-	response.raise_for_status()
-	if response.status_code != 200:
-		print(f"Error posting data to EmonCMS: {response.content}")
-
-def health_check(status):
-	url = f"{HEALTHCHECKS_IO_URL}"
-	payload = {
-		"status": {status},
-		}
-	response = session.post(url, data=payload)
-	response.raise_for_status()
-	if response.status_code != 200:
-		print("Error sending health check ping to healthchecks.io")
+async def post_to_emoncms(node_name, data, stamp=None):
+	await emoncms.post(node_name, data, ts=stamp)
 
 async def update_info_and_display(ip):
 	at = AirTouch(ip)
-	await at.UpdateInfo()
+	with metrics.timer("read", device="airtouch"):
+		start = wall_time()
+		await at.UpdateInfo()
+		stamp = (start + wall_time()) / 2
 	if at.Status != AirTouchStatus.OK:
 		print("Got an error updating info. Exiting")
 		return
@@ -72,6 +85,7 @@ async def update_info_and_display(ip):
 	groups = at.GetGroups()
 
 	data = {"acs": [], "groups": []}
+	rows = []
 	for ac in acs:
 		fan_speed = map_fan_speed(ac.AcFanSpeed)
 		power_state = map_power_state(ac.PowerState)
@@ -89,7 +103,7 @@ async def update_info_and_display(ip):
 		}
 		data["acs"].append(ac_data)
 		ac_node_name = f"AC_{ac_data['AcNumber']}"
-		post_to_emoncms(ac_node_name, json.dumps(ac_data))
+		rows.append((stamp, ac_node_name, ac_data))
 		for group in groups:
 			if group.BelongsToAc == ac.AcNumber:
 				power_state = map_power_state(group.PowerState)
@@ -109,21 +123,25 @@ async def update_info_and_display(ip):
 					group_data.update({"ActiveDelta": active_delta})
 				data["groups"].append(group_data)
 				group_node_name = f"AC_{ac_data['AcNumber']}_Zone_{group_data['GroupNumber']}"
-				post_to_emoncms(group_node_name, json.dumps(group_data))
+				rows.append((stamp, group_node_name, group_data))
 
-	data_str = json.dumps(data)
-	post_to_emoncms("AirTouchData", data_str)
-	health_check("success")
+	outputs.put(rows)
+	# Nested lists are left to EmonCMS to flatten, which only fulljson does
+	await post_to_emoncms("AirTouchData", data, stamp)
+	health.success()
 
 async def main():
-	while True:
-		try:
-			await update_info_and_display(AIRTOUCH_IP)
-			print(f"Data posted to EmonCMS at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}")
-		except Exception as e:
-			print(f"Exception: {str(e)}")
-			health_check("fail")
-		await asyncio.sleep(EMONCMS_UPDATE_INTERVAL)
+	async with metrics, outputs, health:
+		ticker = Ticker(EMONCMS_UPDATE_INTERVAL)
+		while True:
+			try:
+				await update_info_and_display(AIRTOUCH_IP)
+				print(f"Data posted to EmonCMS at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}")
+			except Exception as e:
+				metrics.error("cycle", e)
+				print(f"Exception: {str(e)}")
+				health.error(f"Exception: {str(e)}")
+			await ticker.wait()
 
 if __name__ == "__main__":
 	asyncio.run(main())
@@ -1,34 +1,92 @@
 from influxdb import InfluxDBClient
-from datetime import datetime, timedelta
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import json
 import time
-import calendar
 import asyncio
-import requests
-import json
-import aiohttp
+import argparse
 #import datetime
-
-INTERVAL = 30 * 60
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from emonlib.emoncms import EmonCMS
+from emonlib.scheduler import Ticker
+from emonlib.spool import Spool
+from emonlib.metrics import Metrics
+from emonlib.sinks import Outputs, InfluxSink, MQTTSink
+from demand import DemandTracker, DemandHistory, SETTLE, month_of, month_start, month_bounds, months_between
+from tariffs import Tariff, Series, costs
+
+INTERVAL = 30 * 60 #ON THE HOUR AND HALF HOUR, SETTLE SECONDS LATE SO THE INTERVAL HAS CLOSED
 EMONCMS_API_KEY = "YOUR EMONCMS API KEY"
-EMONCMS_HEADERS = {"Authorization": f"Bearer {EMONCMS_API_KEY}"}
 EMONCMS_SERVER_IP = "YOUR EMONCMS IP"
-
-PREVIOUS_MONTHS_FEED_ID = 529
+SPOOL_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".spool.db"
+METRICS_PORT = 9104 #PROMETHEUS TEXT ON http://127.0.0.1:9104/, None DISABLES
+METRICS_FILE = None #OR A PATH THE SAME TEXT IS WRITTEN TO EVERY 15 SECONDS
+INFLUXDB_URL = None #E.G. "http://localhost:8086" TO WRITE STRAIGHT INTO INFLUXDB AS WELL
+INFLUXDB_DATABASE = "telegraf"
+INFLUXDB_TOPIC_PREFIX = "" #IN FRONT OF <NODE>/<KEY>, E.G. "emon/" IF TELEGRAF'S TOPICS CARRY THE EMONCMS MQTT BASE TOPIC
+MQTT_HOST = None #E.G. "localhost" TO PUBLISH emon/<node> JSON AS WELL, NEEDS paho-mqtt
+
+# Where the net import readings are queried from
+QUERY_HOST = "localhost"
+QUERY_PORT = 8086
+QUERY_USERNAME = "YOUR INFLUXDB ADMIN USERNAME"
+QUERY_PASSWORD = "YOUR INFLUXDB PASSWORD"
+QUERY_DATABASE = "telegraf"
+DEMAND_TOPIC = "SOLAREDGE/NET-DEMAND-IMPORT-KWH"
+CHECKPOINT_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".checkpoint.json"
+HISTORY_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".history.db" #ONE ROW PER CLOSED MONTH, ALSO READ BY DASHBOARDS
+BACKFILL_WORKERS = 4 #INFLUXDB QUERIES IN FLIGHT AT ONCE DURING --backfill
 
 DAILY_SUPPLY_CHARGE = "101" #CENTS
 DEMAND_CHARGE = "342" #CENTS
 AMBER_MONTHLY_CHARGE = "1500" #CENTS
 
-def get_max_difference(start_time_ms, end_time_ms):
-	# Connect to InfluxDB
-	client = InfluxDBClient(host='localhost', port=8086, username='YOUR INFLUXDB ADMIN USERNAME', password='YOUR INFLUXDB PASSWORD', database='telegraf')
+# The tariff above as a profile, --costs compares it with any in --tariffs
+TARIFF = Tariff("current", supply=DAILY_SUPPLY_CHARGE, demand=DEMAND_CHARGE, monthly=AMBER_MONTHLY_CHARGE)
+
+# Interval series --costs prices, as the feeds are named in EmonCMS
+COST_INTERVAL = 300 #SECONDS, AMBER PRICES CHANGE EVERY 5 MINUTES
+IMPORT_KWH_TOPIC = DEMAND_TOPIC
+EXPORT_KWH_TOPIC = "SOLAREDGE/NET-DEMAND-EXPORT-KWH"
+IMPORT_PRICE_TOPIC = "PRICES/AMBER-IMPORT" #C/KWH
+EXPORT_PRICE_TOPIC = "PRICES/AMBER-SOLAR" #C/KWH, POSITIVE WHEN FEED-IN IS PAID
+
+metrics = Metrics("demand", port=METRICS_PORT, path=METRICS_FILE)
+emoncms = EmonCMS(f"http://{EMONCMS_SERVER_IP}", EMONCMS_API_KEY, spool=Spool(SPOOL_PATH), metrics=metrics)
+
+sinks = [emoncms]
+if INFLUXDB_URL:
+	sinks.append(InfluxSink(INFLUXDB_URL, INFLUXDB_DATABASE, topic_prefix=INFLUXDB_TOPIC_PREFIX))
+if MQTT_HOST:
+	sinks.append(MQTTSink(MQTT_HOST))
+outputs = Outputs(sinks, on_error=lambda name, e, rows: print(f"Error posting data to {name}: {e}"))
+
+# One client for the life of the process, it keeps its HTTP session
+client = InfluxDBClient(host=QUERY_HOST, port=QUERY_PORT, username=QUERY_USERNAME, password=QUERY_PASSWORD, database=QUERY_DATABASE)
+
+def query_intervals(start, end):
+	# Last reading of every 30 minute interval in [start, end), epoch seconds
+	query = f"SELECT last(\"value\") FROM \"mqtt_consumer\" WHERE (\"topic\" = '{DEMAND_TOPIC}') AND time >= {int(start * 1000)}ms AND time < {int(end * 1000)}ms GROUP BY time(30m) fill(null)"
+	with metrics.timer("read", device="influxdb"):
+		result = client.query(query, epoch="s")
+	return [(point["time"], point["last"]) for point in result.get_points()]
+
+tracker = DemandTracker(CHECKPOINT_PATH, query_intervals)
+history = DemandHistory(HISTORY_PATH)
+
+# Closed month last posted by this process
+posted_month = None
 
+def get_max_difference(start_time_ms, end_time_ms):
 	# Construct the query
-	query = f"SELECT MAX(*) FROM (SELECT difference(last(\"value\")) FROM \"mqtt_consumer\" WHERE (\"topic\" = 'SOLAREDGE/NET-DEMAND-IMPORT-KWH') AND time >= {start_time_ms}ms AND time <= {end_time_ms}ms GROUP BY time(30m) fill(null)), \"topic\" fill(previous)"
+	query = f"SELECT MAX(*) FROM (SELECT difference(last(\"value\")) FROM \"mqtt_consumer\" WHERE (\"topic\" = '{DEMAND_TOPIC}') AND time >= {start_time_ms}ms AND time <= {end_time_ms}ms GROUP BY time(30m) fill(null)), \"topic\" fill(previous)"
 
 	try:
 		# Query InfluxDB
-		result = client.query(query)
+		with metrics.timer("read", device="influxdb"):
+			result = client.query(query)
 		result_value = list(result.get_points())[0]
 		#value = float("{:.4f}".format(result_value['max_difference']))
 		return float("{:.6f}".format(result_value['max_difference'])) * 2
@@ -38,92 +96,155 @@ def get_max_difference(start_time_ms, end_time_ms):
 		print(f"Error querying InfluxDB: {e}")
 		return None
 
-async def get_feed_value(feed_id):
-    url = f"http://{EMONCMS_SERVER_IP}/feed/value.json?id={feed_id}"
-
-    try:
-        async with aiohttp.ClientSession(headers=EMONCMS_HEADERS) as session:
-            async with session.post(url) as response:
-                response.raise_for_status()
-                return float(await response.text())
-    except Exception as e:
-        print(f"Error getting data from EmonCMS: {e}")
-        return None
-
-
-async def post_to_emoncms(node_name, subname, value):
-	data = {subname: value}
-	json_data = json.dumps(data, separators=(',', ':'))
-	url = f"http://{EMONCMS_SERVER_IP}/input/post.json?node={node_name}&fulljson={json_data}"
-
-	try:
-		async with aiohttp.ClientSession(headers=EMONCMS_HEADERS) as session:
-			async with session.post(url) as response:
-				response.raise_for_status()
-				#print(f"Posted {value} to {node_name} on EmonCMS")
-	except Exception as e:
-		print(f"Error posting data to EmonCMS: {e}")
-
-def get_daily_cost():
-    now = time.time()
-    time_tuple = time.localtime(now)
-    year = time_tuple.tm_year
-    month = time_tuple.tm_mon
-    days_in_month = calendar.monthrange(year, month)[1]
-    daily_cost = int(AMBER_MONTHLY_CHARGE) / days_in_month
-    return daily_cost
+def month_demand(month):
+	# Full query over one month, only needed once per month
+	start, end = month_bounds(month)
+	return get_max_difference(int(start * 1000), int(end * 1000) - 1)
+
+def closed_month_demand(now):
+	# (month, demand, newly worked out) for last month, from the history if
+	# it is there, then from the tracker if it saw the whole month, and only
+	# then from InfluxDB. A month with no data is kept as 0 too, so only a
+	# failed query (None) is tried again on the next run
+	month = month_of(month_start(now) - 1)
+	value = history.get(month)
+	if value is not None:
+		return month, value, False
+	previous = tracker.previous(now)
+	if previous is not None:
+		value, peak_at = previous
+	else:
+		value, peak_at = month_demand(month), None
+	if value is None:
+		return month, value, False
+	history.put(month, value, peak_at)
+	return month, value, True
+
+def first_reading():
+	result = client.query(f"SELECT first(\"value\") FROM \"mqtt_consumer\" WHERE (\"topic\" = '{DEMAND_TOPIC}')", epoch="s")
+	points = list(result.get_points())
+	return points[0]["time"] if points else None
+
+def backfill(since=None, refresh=False):
+	start = datetime.strptime(since, "%Y-%m").timestamp() if since else first_reading()
+	if start is None:
+		print("No readings to backfill from")
+		return
+	months = months_between(start, time.time())
+	if not refresh:
+		known = history.months()
+		months = [month for month in months if month not in known]
+	print(f"Backfilling {len(months)} months with {BACKFILL_WORKERS} workers")
+	with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as pool:
+		for month, value in zip(months, pool.map(month_demand, months)):
+			if value is None:
+				print(f"{month} failed, run again to retry")
+				continue
+			history.put(month, value)
+			print(f"{month} {value:.3f} kW" if value else f"{month} no data")
+
+def print_history():
+	print(f"{'Month':<8} {'Demand kW':>10} {'Cost $':>8}  Peak")
+	for month, value, peak_at in history.rows():
+		peak = datetime.fromtimestamp(peak_at).strftime("%Y-%m-%d %H:%M") if peak_at is not None else ""
+		print(f"{month:<8} {value:>10.3f} {TARIFF.demand_cost(value) / 100:>8.2f}  {peak}")
+
+def query_series(select, topic, fill, start, end):
+	query = f"SELECT {select} AS value FROM \"mqtt_consumer\" WHERE (\"topic\" = '{topic}') AND time >= {int(start)}s AND time < {int(end)}s GROUP BY time({COST_INTERVAL}s) fill({fill})"
+	with metrics.timer("read", device="influxdb"):
+		result = client.query(query, epoch="s")
+	return {point["time"]: point["value"] for point in result.get_points()}
+
+def load_series(start, end):
+	# One query per series for the whole range, all four at once
+	queries = [
+		("difference(last(\"value\"))", IMPORT_KWH_TOPIC, "null"),
+		("difference(last(\"value\"))", EXPORT_KWH_TOPIC, "null"),
+		("mean(\"value\")", IMPORT_PRICE_TOPIC, "previous"),
+		("mean(\"value\")", EXPORT_PRICE_TOPIC, "previous"),
+	]
+	with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as pool:
+		imports, exports, import_prices, export_prices = pool.map(lambda query: query_series(*query, start, end), queries)
+	times = sorted(imports)
+	return Series(times, [imports[t] for t in times], [exports.get(t) for t in times], [import_prices.get(t) for t in times], [export_prices.get(t) for t in times])
+
+def print_costs(since, until=None, profiles=None):
+	start = month_bounds(since)[0]
+	end = month_bounds(until)[1] if until else time.time()
+	tariffs = [TARIFF]
+	if profiles:
+		with open(profiles) as f:
+			tariffs += [Tariff.from_dict(profile) for profile in json.load(f)["tariffs"]]
+	series = load_series(start, end)
+	result = costs(series, tariffs, start, end)
+	print(f"{len(series)} intervals, {len(tariffs)} tariffs")
+	print(f"{'Month':<8} {'kWh in':>9} {'kWh out':>9} {'Peak kW':>8} " + " ".join(f"{tariff.name[:12]:>12}" for tariff in tariffs))
+	totals = [0.0] * len(tariffs)
+	for month, charges in result[TARIFF.name].items():
+		line = [result[tariff.name][month]["total"] for tariff in tariffs]
+		totals = [total + value for total, value in zip(totals, line)]
+		print(f"{month:<8} {charges['import_kwh']:>9.1f} {charges['export_kwh']:>9.1f} {charges['peak_kw']:>8.3f} " + " ".join(f"{value / 100:>12.2f}" for value in line))
+	print(f"{'Total':<36} " + " ".join(f"{value / 100:>12.2f}" for value in totals))
+
+def post_to_emoncms(node_name, data):
+	outputs.put([(None, node_name, data)])
 
 async def update_info_and_display():
-	# Get the current time and dates for this month and last month
-	now = datetime.now().replace(microsecond=0)
-	last_month_end = now.replace(day=1) - timedelta(days=1)
-	last_month_start = last_month_end.replace(day=1)
-	this_month_start = now.replace(day=1)
-	this_month_end = now
-
-	# Check if it's the 1st of the month at midnight
-	#if now.day == 1 and now.hour == 0 and now.minute == 0:
-
-	# Convert the start and end dates for last month to milliseconds
-	start_time_ms = int(last_month_start.timestamp() * 1000)
-	end_time_ms = int(last_month_end.timestamp() * 1000)
-
-	# Call the get_max_difference function for last month
-	max_difference = get_max_difference(start_time_ms, end_time_ms)
-	if max_difference > 0:
-		if await get_feed_value(PREVIOUS_MONTHS_FEED_ID) != max_difference:
-			await post_to_emoncms("MAX-30M-DEMAND", "previous-months", max_difference)
-			await post_to_emoncms("MAX-30M-DEMAND", "previous-months-cost", max_difference)
-			await post_to_emoncms("MAX-30M-DEMAND", "previous-months-cost", max_difference * float(DEMAND_CHARGE))
-		else:
-			print("No changes for last month")
+	start_time = time.time()
+	# Only the intervals closed since the last run are queried
+	tracker.update(start_time)
+
+	# A closed month never changes, it is worked out once and posted once
+	global posted_month
+	month, max_difference, fresh = closed_month_demand(start_time)
+	if max_difference:
+		if fresh or posted_month != month:
+			post_to_emoncms("MAX-30M-DEMAND", {
+				"previous-months": max_difference,
+				"previous-months-cost": TARIFF.demand_cost(max_difference),
+			})
+			posted_month = month
 	else:
 		print("No data found for last month")
 
-	# Convert the start and end dates for this month to milliseconds
-	start_time_ms = int(this_month_start.timestamp() * 1000)
-	end_time_ms = int(this_month_end.timestamp() * 1000)
-
-	# Call the get_max_difference function for this month
-	max_difference = get_max_difference(start_time_ms, end_time_ms)
+	max_difference = tracker.current(start_time)
 	if max_difference == 0:
 		print("No data found for this month")
-	await post_to_emoncms("MAX-30M-DEMAND", "current-month", max_difference)
-	await post_to_emoncms("MAX-30M-DEMAND", "demand-charge", float(DEMAND_CHARGE))
-	await post_to_emoncms("MAX-30M-DEMAND", "daily-supply-charge", float(DAILY_SUPPLY_CHARGE))
-	await post_to_emoncms("MAX-30M-DEMAND", "daily-monthly-charge", get_daily_cost())
-	await post_to_emoncms("MAX-30M-DEMAND", "current-month-cost", max_difference * float(DEMAND_CHARGE))
+	post_to_emoncms("MAX-30M-DEMAND", {
+		"current-month": max_difference,
+		"demand-charge": TARIFF.demand,
+		"daily-supply-charge": TARIFF.supply,
+		"daily-monthly-charge": TARIFF.daily_fixed(start_time),
+		"current-month-cost": TARIFF.demand_cost(max_difference),
+	})
 	#else:
 		#print("No data found for this month")
+	metrics.observe("cycle", time.time() - start_time)
 
 async def main():
 	print("Starting up...")
-	await update_info_and_display()
-	print("Running.")
-	while True:
-		await asyncio.sleep(INTERVAL)
+	async with metrics, outputs:
 		await update_info_and_display()
+		print("Running.")
+		async for tick in Ticker(INTERVAL, offset=SETTLE):
+			await update_info_and_display()
 
 if __name__ == "__main__":
-	asyncio.run(main())
+	parser = argparse.ArgumentParser(description="Monthly 30 minute peak demand for EmonCMS")
+	parser.add_argument("--backfill", action="store_true", help="work out every closed month missing from the history, then exit")
+	parser.add_argument("--since", help="YYYY-MM to backfill from, default the month of the first reading")
+	parser.add_argument("--refresh", action="store_true", help="with --backfill, work out months already in the history again")
+	parser.add_argument("--history", action="store_true", help="print the demand history and exit")
+	parser.add_argument("--costs", metavar="YYYY-MM", help="price every month from this one under TARIFF and any --tariffs, then exit")
+	parser.add_argument("--until", metavar="YYYY-MM", help="last month for --costs, default up to now")
+	parser.add_argument("--tariffs", metavar="PATH", help="JSON tariff profiles to compare, see tariffs.example.json")
+	args = parser.parse_args()
+	if args.backfill:
+		backfill(args.since, args.refresh)
+	elif args.history:
+		print_history()
+	elif args.costs:
+		print_costs(args.costs, args.until, args.tariffs)
+	else:
+		asyncio.run(main())
 
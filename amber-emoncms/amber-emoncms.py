@@ -1,32 +1,58 @@
 #!/usr/bin/python3
 
+import os
+import sys
 import time
+import asyncio
 import datetime
 import requests
-import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from emonlib.emoncms import EmonCMS
+from emonlib.spool import Spool
+from emonlib.scheduler import Ticker
+from emonlib.metrics import Metrics
+from emonlib.sinks import Outputs, InfluxSink, MQTTSink
+from emonlib.clock import wall_time
 
 HEALTH_CHECK_URL = "YOUR HEALTHCHECK URL"
 EMONCMS_HOST = "http:// - YOUR EMONCMS IP RO FQDN"
-INTERVAL = 275 #SECONDS
+INTERVAL = 300 #SECONDS
+INTERVAL_OFFSET = 10 #SECONDS AFTER EACH 5 MINUTE PRICE INTERVAL STARTS
 SITE_ID = "YOUR AMBER ENERGY SITE_ID"
 AMBER_PRICE_URL = f"https://api.amber.com.au/v1/sites/{SITE_ID}/prices/current"
 AMBER_JSON_HEADERS = {"accept": "application/json"}
 AMBER_HEADERS = {"Authorization": "Bearer YOUR AMBER API-KEY"}
 NODE_NAME = "PRICES"
 EMONCMS_API_KEY = 'YOUR EMONCMS API KEY'
-EMONCMS_HEADERS = {"Authorization": f"Bearer {EMONCMS_API_KEY}"}
+SPOOL_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".spool.db"
+METRICS_PORT = 9103 #PROMETHEUS TEXT ON http://127.0.0.1:9103/, None DISABLES
+METRICS_FILE = None #OR A PATH THE SAME TEXT IS WRITTEN TO EVERY 15 SECONDS
+INFLUXDB_URL = None #E.G. "http://localhost:8086" TO WRITE STRAIGHT INTO INFLUXDB AS WELL
+INFLUXDB_DATABASE = "telegraf"
+INFLUXDB_TOPIC_PREFIX = "" #IN FRONT OF <NODE>/<KEY>, E.G. "emon/" IF TELEGRAF'S TOPICS CARRY THE EMONCMS MQTT BASE TOPIC
+MQTT_HOST = None #E.G. "localhost" TO PUBLISH emon/<node> JSON AS WELL, NEEDS paho-mqtt
 
 session = requests.Session()
+metrics = Metrics("amber", port=METRICS_PORT, path=METRICS_FILE)
+emoncms = EmonCMS(EMONCMS_HOST, EMONCMS_API_KEY, verify=False, spool=Spool(SPOOL_PATH), metrics=metrics)
 
-def clear_emoncms_data():
-	url_clean = f"{EMONCMS_HOST}/emoncms/input/clean"
-	response = session.post(url_clean, headers=EMONCMS_HEADERS, verify=False)
-	response.raise_for_status()
+sinks = [emoncms]
+if INFLUXDB_URL:
+	sinks.append(InfluxSink(INFLUXDB_URL, INFLUXDB_DATABASE, topic_prefix=INFLUXDB_TOPIC_PREFIX))
+if MQTT_HOST:
+	sinks.append(MQTTSink(MQTT_HOST))
+outputs = Outputs(sinks, on_error=lambda name, e, rows: print(f"Error posting data to {name}: {e}"))
+
+async def clear_emoncms_data():
+	await emoncms.request("emoncms/input/clean")
 	print("Cleared emonCMS data")
 
-def post_emoncms_data():
-	response = session.get(AMBER_PRICE_URL, headers=AMBER_HEADERS, verify=True)
-	response.raise_for_status()
+async def post_emoncms_data():
+	with metrics.timer("read", device="amber"):
+		start = wall_time()
+		response = session.get(AMBER_PRICE_URL, headers=AMBER_HEADERS, verify=True)
+		stamp = (start + wall_time()) / 2
+		response.raise_for_status()
 	data = response.json()
 	general = data[0]
 	feedin = data[1]
@@ -39,43 +65,49 @@ def post_emoncms_data():
 		"ORIGIN-SOLAR": 5,
 		"ORIGIN-IMPORT": 25.82,
 	}
-	data = json.dumps(data, indent=4, separators=(',', ':'))
-	url = f"{EMONCMS_HOST}/input/post?node={NODE_NAME}&fulljson={data}"
-	response = session.post(url, headers=EMONCMS_HEADERS, verify=False)
-	response.raise_for_status()
+	outputs.put([(stamp, NODE_NAME, data)])
 
-while True:
+async def update_info_and_display():
 	try:
 		start_time = time.time()
-		post_emoncms_data()
+		await post_emoncms_data()
 
 		if datetime.datetime.now().minute % 10 == 0:
-			clear_emoncms_data()
+			await clear_emoncms_data()
 
-		if session.head(HEALTH_CHECK_URL, timeout=1).status_code != 200:
+		with metrics.timer("health"):
+			status_code = session.head(HEALTH_CHECK_URL, timeout=1).status_code
+		if status_code != 200:
 			print("Health check connection failure")
-			continue
+			return
 
-		# Calculate and print the time it took to run the loop
-		end_time = time.time()
-#		print(f"Loop finished in {end_time - start_time:.3f} seconds")
-		time.sleep(INTERVAL)
+		metrics.observe("cycle", time.time() - start_time)
 
 	except requests.exceptions.Timeout as e:
+		metrics.error("cycle", e)
 		print("Connection Timeout Exception")
-		continue
+		return
 
 	except requests.exceptions.HTTPError as e:
+		metrics.error("cycle", e)
 		print(f"HTTP Error: {e.response.status_code} - {e.response.reason}")
-		time.sleep(INTERVAL)
-		continue
+		return
 
 	except requests.exceptions.RequestException as e:
+		metrics.error("cycle", e)
 		print("Request Exception:", e)
-		time.sleep(INTERVAL)
-		continue
+		return
 
 	except Exception as e:
+		metrics.error("cycle", e)
 		print("Exception:", e)
-		time.sleep(INTERVAL)
-		continue
+		return
+
+async def main():
+	async with metrics, outputs:
+		await update_info_and_display()
+		async for tick in Ticker(INTERVAL, offset=INTERVAL_OFFSET):
+			await update_info_and_display()
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -0,0 +1,155 @@
+import os
+import json
+import sqlite3
+import time
+from datetime import datetime
+
+from emonlib.months import WINDOW, month_of, month_start, interval_start
+
+# Incremental 30 minute demand tracking. Rather than scanning the whole month
+# on every run, the running monthly maximum of 30 minute import and the end of
+# the last closed interval are kept in a JSON checkpoint, and each run only
+# asks the source for the intervals that have closed since.
+#
+# query(start, end) returns [(interval_start, last_value), ...] for every
+# 30 minute interval in [start, end), epoch seconds, with last_value the last
+# meter reading (kWh) in the interval or None if there was none. The import
+# in an interval is the rise in the reading since the previous interval that
+# had one, as difference(last(...)) works it out in InfluxDB, and demand is
+# that import doubled (kWh per half hour to kW).
+#
+# Intervals count towards the month (local time) they start in. When the
+# first interval of a new month closes, the finished month's peak is kept as
+# "previous" and the running maximum starts again. A month is only "whole"
+# if the tracker saw it from its first interval.
+#
+# A closed month's peak never changes, so DemandHistory keeps one row per
+# month in SQLite, worked out once (or by a backfill) and read from then on.
+# The same table is what billing dashboards read the demand history from.
+
+SETTLE = 60 #SECONDS AFTER AN INTERVAL ENDS BEFORE ITS LAST READINGS ARE COUNTED
+
+def previous_month(ts):
+	# (start, end) epoch seconds of the month before the one ts is in
+	end = month_start(ts)
+	return month_start(end - 1), end
+
+def months_between(start, end):
+	# "YYYY-MM" of every month from the one start is in up to, not including,
+	# the one end is in
+	months = []
+	ts = month_start(start)
+	while ts < month_start(end):
+		months.append(month_of(ts))
+		ts = month_start(ts + 32 * 86400)
+	return months
+
+def month_bounds(month):
+	start = datetime.strptime(month, "%Y-%m").timestamp()
+	return start, month_start(start + 32 * 86400)
+
+def demand(kwh):
+	return float("{:.6f}".format(kwh)) * 2
+
+class DemandTracker:
+
+	def __init__(self, path, query, window=WINDOW, settle=SETTLE):
+		self.path = path
+		self.query = query
+		self.window = window
+		self.settle = settle
+		self.state = self.load()
+		self.stats = {"queries": 0, "intervals": 0, "failed": 0}
+
+	def load(self):
+		try:
+			with open(self.path) as f:
+				return json.load(f)
+		except FileNotFoundError:
+			pass
+		except (OSError, ValueError) as e:
+			print(f"Ignoring unreadable demand checkpoint {self.path}: {e}")
+		return {"month": None, "whole": False, "peak": 0.0, "peak_at": None, "closed": None, "last": None, "previous": None}
+
+	def save(self):
+		temp = self.path + ".tmp"
+		with open(temp, "w") as f:
+			json.dump(self.state, f)
+		os.replace(temp, self.path)
+
+	def add(self, ts, value):
+		state = self.state
+		month = month_of(ts)
+		if month != state["month"]:
+			if state["month"] is not None:
+				state["previous"] = {"month": state["month"], "whole": state.get("whole", False), "peak": state["peak"], "peak_at": state["peak_at"]}
+			state.update({"month": month, "whole": state["month"] is not None or ts == month_start(ts), "peak": 0.0, "peak_at": None})
+		if value is None:
+			return
+		if state["last"] is not None and value - state["last"] > state["peak"]:
+			state["peak"] = value - state["last"]
+			state["peak_at"] = ts
+		state["last"] = value
+
+	def update(self, now):
+		# Folds in every interval closed by now, returns False if the query failed
+		end = interval_start(now - self.settle, self.window)
+		start = self.state["closed"]
+		if start is None:
+			start = month_start(now)
+		if end <= start:
+			return True
+		try:
+			points = self.query(start, end)
+		except Exception as e:
+			print(f"Error querying demand intervals: {e}")
+			self.stats["failed"] += 1
+			return False
+		self.stats["queries"] += 1
+		for ts, value in sorted(points):
+			if start <= ts < end:
+				self.add(ts, value)
+				self.stats["intervals"] += 1
+		self.state["closed"] = end
+		self.save()
+		return True
+
+	def current(self, now):
+		# This month's peak demand so far (kW), 0 until an interval has closed
+		if self.state["month"] != month_of(now):
+			return 0.0
+		return demand(self.state["peak"])
+
+	def previous(self, now):
+		# (demand kW, peak_at) of last month if this tracker saw all of it
+		previous = self.state["previous"]
+		if previous is None or not previous.get("whole") or previous["month"] != month_of(month_start(now) - 1):
+			return None
+		return demand(previous["peak"]), previous["peak_at"]
+
+class DemandHistory:
+
+	def __init__(self, path):
+		self.path = path
+		self.db = sqlite3.connect(path)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("CREATE TABLE IF NOT EXISTS demand (month TEXT PRIMARY KEY, demand REAL NOT NULL, peak_at INTEGER, computed_at REAL NOT NULL)")
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+	def get(self, month):
+		row = self.db.execute("SELECT demand FROM demand WHERE month = ?", (month,)).fetchone()
+		return None if row is None else row[0]
+
+	def put(self, month, value, peak_at=None):
+		with self.db:
+			self.db.execute("INSERT OR REPLACE INTO demand (month, demand, peak_at, computed_at) VALUES (?, ?, ?, ?)", (month, value, peak_at, time.time()))
+
+	def months(self):
+		return {month for month, in self.db.execute("SELECT month FROM demand")}
+
+	def rows(self):
+		# (month, demand kW, peak_at) oldest first
+		return self.db.execute("SELECT month, demand, peak_at FROM demand ORDER BY month").fetchall()
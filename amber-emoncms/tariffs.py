@@ -0,0 +1,163 @@
+import math
+from array import array
+
+from emonlib.months import WINDOW, month_of, month_start
+from demand import month_bounds, months_between
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# Tariff profiles and bulk cost calculation. A Series holds interval energy
+# (kWh imported and exported per interval) and the prices paid for it (c/kWh,
+# export price positive when feed-in is credited) over any date range. costs()
+# reduces it to per month sums once, usage and feed-in at interval prices,
+# energy totals and the peak 30 minute demand, and then prices every tariff
+# profile from those sums, so comparing several profiles costs no more than
+# working out one.
+#
+# The sums are done with NumPy when it is installed (pip install numpy) and
+# in plain Python otherwise, with the same results.
+#
+# All amounts are in cents, as the tariff constants are.
+
+class Tariff:
+
+	def __init__(self, name, supply=0.0, demand=0.0, monthly=0.0, usage=None, feed_in=None):
+		self.name = name
+		self.supply = float(supply) #C PER DAY
+		self.demand = float(demand) #C PER KW OF THE MONTH'S PEAK 30 MINUTE DEMAND
+		self.monthly = float(monthly) #C PER MONTH, SPREAD OVER ITS DAYS
+		self.usage = None if usage is None else float(usage) #FLAT C/KWH, None PAYS THE INTERVAL PRICE
+		self.feed_in = None if feed_in is None else float(feed_in) #FLAT C/KWH, None IS CREDITED THE INTERVAL PRICE
+
+	def __repr__(self):
+		return f"Tariff({self.name})"
+
+	@classmethod
+	def from_dict(cls, profile):
+		return cls(profile["name"], profile.get("supply", 0), profile.get("demand", 0), profile.get("monthly", 0), profile.get("usage"), profile.get("feed_in"))
+
+	def daily_fixed(self, ts):
+		# Monthly charge per day in the month ts is in
+		start, end = month_bounds(month_of(ts))
+		return self.monthly / round((end - start) / 86400)
+
+	def demand_cost(self, peak_kw):
+		return peak_kw * self.demand
+
+	def price(self, sums):
+		# Charges for one month from its sums
+		usage = sums["usage"] if self.usage is None else sums["import_kwh"] * self.usage
+		feed_in = sums["feed_in"] if self.feed_in is None else sums["export_kwh"] * self.feed_in
+		supply = sums["days"] * self.supply
+		fixed = self.monthly * sums["days"] / sums["month_days"]
+		demand = self.demand_cost(sums["peak_kw"])
+		return {
+			"usage": usage,
+			"feed_in": feed_in,
+			"supply": supply,
+			"fixed": fixed,
+			"demand": demand,
+			"total": usage - feed_in + supply + fixed + demand,
+		}
+
+class Series:
+
+	def __init__(self, times, imports, exports, import_prices, export_prices):
+		# Interval start times (epoch seconds, in order) and one value per
+		# interval each
+		if np is not None:
+			self.times = np.asarray(times, dtype="float64")
+			self.imports = np.clip(np.nan_to_num(np.asarray(imports, dtype="float64")), 0, None)
+			self.exports = np.clip(np.nan_to_num(np.asarray(exports, dtype="float64")), 0, None)
+			self.import_prices = np.nan_to_num(np.asarray(import_prices, dtype="float64"))
+			self.export_prices = np.nan_to_num(np.asarray(export_prices, dtype="float64"))
+		else:
+			self.times = array("d", times)
+			self.imports = array("d", (clean(v, 0.0) for v in imports))
+			self.exports = array("d", (clean(v, 0.0) for v in exports))
+			self.import_prices = array("d", (clean(v) for v in import_prices))
+			self.export_prices = array("d", (clean(v) for v in export_prices))
+
+	def __len__(self):
+		return len(self.times)
+
+def clean(v, low=None):
+	# Missing or NaN to 0, and counter resets (negative energy) to low
+	if v is None or math.isnan(v):
+		return 0.0
+	return v if low is None else max(low, v)
+
+def month_sums_numpy(series, starts, start, end):
+	inside = (series.times >= start) & (series.times < end)
+	times = series.times[inside]
+	imports = series.imports[inside]
+	exports = series.exports[inside]
+	index = np.searchsorted(starts, times, side="right") - 1
+	count = len(starts)
+	sums = {
+		"import_kwh": np.bincount(index, weights=imports, minlength=count),
+		"export_kwh": np.bincount(index, weights=exports, minlength=count),
+		"usage": np.bincount(index, weights=imports * series.import_prices[inside], minlength=count),
+		"feed_in": np.bincount(index, weights=exports * series.export_prices[inside], minlength=count),
+	}
+	# Import per aligned 30 minute window, then the biggest window per month
+	windows = np.floor(times / WINDOW).astype("int64")
+	unique, window_index = np.unique(windows, return_inverse=True)
+	window_kwh = np.bincount(window_index, weights=imports)
+	window_month = np.searchsorted(starts, unique * WINDOW, side="right") - 1
+	peak = np.zeros(count)
+	np.maximum.at(peak, window_month, window_kwh)
+	sums["peak_kw"] = peak * 3600 / WINDOW
+	return {k: v.tolist() for k, v in sums.items()}
+
+def month_sums_python(series, starts, start, end):
+	count = len(starts)
+	sums = {k: [0.0] * count for k in ("import_kwh", "export_kwh", "usage", "feed_in", "peak_kw")}
+	windows = {}
+	month = 0
+	for ts, imported, exported, import_price, export_price in zip(series.times, series.imports, series.exports, series.import_prices, series.export_prices):
+		if ts < start or ts >= end:
+			continue
+		# Times are in order, so the month only ever moves forward
+		while month + 1 < count and ts >= starts[month + 1]:
+			month += 1
+		sums["import_kwh"][month] += imported
+		sums["export_kwh"][month] += exported
+		sums["usage"][month] += imported * import_price
+		sums["feed_in"][month] += exported * export_price
+		window = math.floor(ts / WINDOW)
+		windows[window] = windows.get(window, 0.0) + imported
+	month = 0
+	for window in sorted(windows):
+		while month + 1 < count and window * WINDOW >= starts[month + 1]:
+			month += 1
+		sums["peak_kw"][month] = max(sums["peak_kw"][month], windows[window] * 3600 / WINDOW)
+	return sums
+
+def costs(series, tariffs, start, end):
+	# {tariff name: {month: charges}} for [start, end), epoch seconds
+	months = months_between(start, end)
+	if month_start(end) < end:
+		months.append(month_of(end))
+	bounds = [month_bounds(month) for month in months]
+	starts = [first for first, last in bounds]
+	if np is not None:
+		sums = month_sums_numpy(series, np.asarray(starts), start, end)
+	else:
+		sums = month_sums_python(series, starts, start, end)
+	result = {tariff.name: {} for tariff in tariffs}
+	for i, (month, (first, last)) in enumerate(zip(months, bounds)):
+		covered = min(end, last) - max(start, first)
+		if covered <= 0:
+			continue
+		month_sums = {k: v[i] for k, v in sums.items()}
+		month_sums["days"] = covered / 86400
+		month_sums["month_days"] = (last - first) / 86400
+		for tariff in tariffs:
+			charges = tariff.price(month_sums)
+			charges.update({"import_kwh": month_sums["import_kwh"], "export_kwh": month_sums["export_kwh"], "peak_kw": month_sums["peak_kw"]})
+			result[tariff.name][month] = charges
+	return result
@@ -0,0 +1,2 @@
+# Shared helpers for the collector scripts. Each script puts the repository
+# root on sys.path before importing from here.
@@ -0,0 +1,164 @@
+import math
+from array import array
+
+from emonlib.clock import wall_time
+
+# Windowed aggregation. Readings can be taken as fast as the devices answer
+# while only one record per node is published per window. Windows are aligned
+# to whole multiples of the window length since the epoch and each record is
+# stamped with the start of its window.
+#
+# Per node the running count, sum, min, max and last value of every numeric
+# key live in preallocated array('d') buffers that are reset in place at each
+# window boundary, so steady state sampling allocates nothing per key.
+#
+# Which statistics are published is set per key, {key: ("mean", "max")}. The
+# first one is published under the key itself and any others as key_<stat>,
+# e.g. power_ac, power_ac_max. Keys without an entry publish the default
+# statistic, except counters and states (energy totals, status, scale
+# factors) which always publish their last value. Non-numeric values are
+# passed through as their last value.
+
+MEAN = "mean"
+MIN = "min"
+MAX = "max"
+LAST = "last"
+
+LAST_KEYS = {"status", "status_internal", "vendor_status"}
+
+def default_stats(k, default):
+	if "energy" in k or k.startswith("c_") or k.endswith("_scale") or k in LAST_KEYS:
+		return (LAST,)
+	return (default,)
+
+class Window:
+
+	__slots__ = ("start", "index", "keys", "count", "sum", "min", "max", "last", "other")
+
+	def __init__(self, start):
+		self.start = start
+		self.index = {}
+		self.keys = []
+		self.count = array("L")
+		self.sum = array("d")
+		self.min = array("d")
+		self.max = array("d")
+		self.last = array("d")
+		self.other = {}
+
+	def slot(self, k):
+		i = self.index[k] = len(self.keys)
+		self.keys.append(k)
+		self.count.append(0)
+		self.sum.append(0.0)
+		self.min.append(math.inf)
+		self.max.append(-math.inf)
+		self.last.append(0.0)
+		return i
+
+	def empty(self):
+		return not self.other and not any(self.count)
+
+	def reset(self, start):
+		self.start = start
+		for i in range(len(self.keys)):
+			self.count[i] = 0
+			self.sum[i] = 0.0
+			self.min[i] = math.inf
+			self.max[i] = -math.inf
+		self.other.clear()
+
+	def add(self, data):
+		index = self.index
+		count, total, low, high, last = self.count, self.sum, self.min, self.max, self.last
+		for k, v in data.items():
+			if isinstance(v, (int, float)) and not isinstance(v, bool):
+				i = index.get(k)
+				if i is None:
+					i = self.slot(k)
+				count[i] += 1
+				total[i] += v
+				if v < low[i]:
+					low[i] = v
+				if v > high[i]:
+					high[i] = v
+				last[i] = v
+			else:
+				self.other[k] = v
+
+class WindowAggregator:
+
+	def __init__(self, window, keys=None, default=MEAN):
+		if window <= 0:
+			raise ValueError("Aggregation window must be above 0")
+		self.window = window
+		self.keys = keys or {}
+		self.default = default
+		self.windows = {}
+		self.outputs = {}
+		self.stats = {"samples": 0, "records": 0}
+
+	def start_of(self, ts):
+		return math.floor(ts / self.window) * self.window
+
+	def plan(self, k):
+		# Output names and statistics for a key, worked out once
+		outputs = self.outputs.get(k)
+		if outputs is None:
+			stats = self.keys.get(k) or default_stats(k, self.default)
+			outputs = self.outputs[k] = [(k if n == 0 else f"{k}_{stat}", stat) for n, stat in enumerate(stats)]
+		return outputs
+
+	def record(self, node, window):
+		data = {}
+		for k, i in window.index.items():
+			count = window.count[i]
+			if not count:
+				continue
+			for name, stat in self.plan(k):
+				if stat == MEAN:
+					data[name] = window.sum[i] / count
+				elif stat == MIN:
+					data[name] = window.min[i]
+				elif stat == MAX:
+					data[name] = window.max[i]
+				else:
+					data[name] = window.last[i]
+		data.update(window.other)
+		self.stats["records"] += 1
+		return (window.start, node, data)
+
+	def add(self, ts, node, data):
+		# Returns the record of the window this sample closed, if any
+		ts = wall_time() if ts is None else ts
+		start = self.start_of(ts)
+		window = self.windows.get(node)
+		closed = None
+		if window is None:
+			window = self.windows[node] = Window(start)
+		elif start > window.start:
+			if not window.empty():
+				closed = self.record(node, window)
+			window.reset(start)
+		# A late sample from the previous window is folded into the current one
+		window.add(data)
+		self.stats["samples"] += 1
+		return closed
+
+	def flush(self, now=None, force=False):
+		# Records for every window that has closed by now, or all with force
+		start = self.start_of(wall_time() if now is None else now)
+		closed = []
+		for node, window in self.windows.items():
+			if (force or window.start < start) and not window.empty():
+				closed.append(self.record(node, window))
+				window.reset(start)
+		return closed
+
+	def rows(self, rows, now=None):
+		closed = []
+		for ts, node, data in rows:
+			row = self.add(ts, node, data)
+			if row is not None:
+				closed.append(row)
+		return closed + self.flush(now)
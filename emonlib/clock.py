@@ -0,0 +1,32 @@
+import time
+
+# Sample timestamps. wall_time() is the monotonic clock anchored to the wall
+# clock, so stamps taken within a process never run backwards or jump when
+# NTP slews the system time. The anchor is checked against time.time() every
+# RESYNC seconds and moved if the two disagree by more than STEP seconds
+# (a real clock step, e.g. the Pi setting its time after boot).
+
+RESYNC = 60 #SECONDS
+STEP = 1.0 #SECONDS
+
+class Clock:
+
+	def __init__(self):
+		self.sync()
+
+	def sync(self):
+		self.checked = time.monotonic()
+		self.offset = time.time() - self.checked
+
+	def now(self):
+		monotonic = time.monotonic()
+		if monotonic - self.checked >= RESYNC:
+			self.checked = monotonic
+			if abs(time.time() - (self.offset + monotonic)) > STEP:
+				self.offset = time.time() - monotonic
+		return self.offset + monotonic
+
+clock = Clock()
+
+def wall_time():
+	return clock.now()
@@ -0,0 +1,48 @@
+import time
+
+# Change-only publishing. For each node the last value sent per key is kept
+# and a key is only sent again when it moves by more than its deadband, or
+# when HEARTBEAT seconds have passed since it was last sent. The deadband for
+# a key is the larger of its absolute band and its relative band times the
+# last sent value, so with both at 0 only unchanged values are held back.
+
+HEARTBEAT = 60 #SECONDS
+
+class PublishFilter:
+
+	def __init__(self, absolute=0.0, relative=0.0, heartbeat=HEARTBEAT, keys=None):
+		self.absolute = absolute
+		self.relative = relative
+		self.heartbeat = heartbeat
+		# Per key overrides, {key: (absolute, relative)}
+		self.keys = keys or {}
+		self.sent = {}
+		self.stats = {"sent": 0, "suppressed": 0}
+
+	def changed(self, k, previous, v):
+		if not isinstance(v, (int, float)) or not isinstance(previous, (int, float)):
+			return v != previous
+		absolute, relative = self.keys.get(k, (self.absolute, self.relative))
+		return abs(v - previous) > max(absolute, relative * abs(previous))
+
+	def filter(self, node, data, now=None):
+		now = time.monotonic() if now is None else now
+		sent = self.sent.setdefault(node, {})
+		out = {}
+		for k, v in data.items():
+			last = sent.get(k)
+			if last is None or now - last[1] >= self.heartbeat or self.changed(k, last[0], v):
+				out[k] = v
+				sent[k] = (v, now)
+		self.stats["sent"] += len(out)
+		self.stats["suppressed"] += len(data) - len(out)
+		# Nothing held back, pass the row's own data (e.g. a Record) through
+		return data if len(out) == len(data) else out
+
+	def rows(self, rows, now=None):
+		filtered = []
+		for ts, node, data in rows:
+			data = self.filter(node, data, now)
+			if data:
+				filtered.append((ts, node, data))
+		return filtered
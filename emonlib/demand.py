@@ -0,0 +1,162 @@
+import os
+import json
+
+from emonlib.months import WINDOW, month_of, month_start, interval_start
+
+# Live demand projection. Demand charges are set by the highest average
+# import over any aligned 30 minute window in the month; rather than finding
+# a new peak after the window has closed, import power samples are integrated
+# (trapezoid rule) into the current window's energy as they arrive, and the
+# window's average demand is projected to its end assuming the latest power
+# holds for the rest of it.
+#
+# The month's peak of closed windows is kept (and persisted to path, if
+# given) so each estimate also carries the margin left before a new peak is
+# set. A negative margin means the window is on course to set one.
+#
+# Windows closed here only make the month's peak when none were missed, so
+# the peak (and margin) is only given once it is known: seeded for the month
+# from the authoritative figure, e.g. amber-demand-charge.py's checkpoint of
+# every closed interval in the meter history (see seed_from), or seen here
+# from the month's first window with none missed since.
+#
+# Windows and months are as emonlib/months.py defines them. Power is in W and
+# demand in kW.
+
+PUBLISH_EVERY = 5 #SECONDS
+
+class DemandEstimator:
+
+	def __init__(self, window=WINDOW, every=PUBLISH_EVERY, path=None):
+		self.window = window
+		self.every = every
+		self.path = path
+		self.start = None
+		self.energy = 0.0 #WH SO FAR THIS WINDOW
+		self.last = None
+		self.published = None
+		self.peak = self.load()
+		self.stats = {"samples": 0, "windows": 0, "peaks": 0, "gaps": 0, "seeds": 0}
+
+	def month_state(self, month, whole=False):
+		# closed is the start of the last window closed here
+		return {"month": month, "peak": 0.0, "peak_at": None, "closed": None, "whole": whole, "seeded": False}
+
+	def load(self):
+		state = self.month_state(None)
+		if self.path is not None:
+			try:
+				with open(self.path) as f:
+					state.update(json.load(f))
+			except FileNotFoundError:
+				pass
+			except (OSError, ValueError) as e:
+				print(f"Ignoring unreadable demand state {self.path}: {e}")
+		return state
+
+	def save(self):
+		if self.path is None:
+			return
+		temp = self.path + ".tmp"
+		with open(temp, "w") as f:
+			json.dump(self.peak, f)
+		os.replace(temp, self.path)
+
+	def demand(self, energy):
+		return energy * 3600 / self.window / 1000
+
+	def close(self):
+		value = self.demand(self.energy)
+		month = month_of(self.start)
+		if month != self.peak["month"]:
+			self.peak = self.month_state(month, whole=self.start == month_start(self.start))
+		elif self.peak["closed"] is None or self.start != self.peak["closed"] + self.window:
+			# A window was missed (a gap, or the collector was down)
+			self.peak["whole"] = False
+		self.peak["closed"] = self.start
+		if value > self.peak["peak"]:
+			self.peak.update({"peak": value, "peak_at": self.start})
+			self.stats["peaks"] += 1
+		self.save()
+		self.stats["windows"] += 1
+
+	def seed(self, month, peak, peak_at=None):
+		# The month's peak (kW) from an authoritative source. A seed for an
+		# earlier month (a checkpoint not rolled over yet, or left stale) is
+		# ignored, returns False then
+		if self.peak["month"] is not None and month < self.peak["month"]:
+			return False
+		if month != self.peak["month"]:
+			self.peak = self.month_state(month)
+		self.peak["seeded"] = True
+		if peak > self.peak["peak"]:
+			self.peak.update({"peak": peak, "peak_at": peak_at})
+		self.stats["seeds"] += 1
+		self.save()
+		return True
+
+	def seed_from(self, path):
+		# From amber-demand-charge.py's checkpoint, which keeps the month's
+		# peak import in one window (kWh), returns False if there is none
+		try:
+			with open(path) as f:
+				state = json.load(f)
+		except FileNotFoundError:
+			return False
+		except (OSError, ValueError) as e:
+			print(f"Ignoring unreadable demand checkpoint {path}: {e}")
+			return False
+		if state.get("month") is None:
+			return False
+		return self.seed(state["month"], state["peak"] * 3600 / self.window, state.get("peak_at"))
+
+	def known(self, month):
+		return self.peak["month"] == month and (self.peak["seeded"] or self.peak["whole"])
+
+	def add(self, ts, power):
+		power = max(0.0, power)
+		self.stats["samples"] += 1
+		if self.last is not None and ts - self.last[0] > self.window:
+			# Too long without samples to say what the windows in between held
+			self.stats["gaps"] += 1
+			self.last = None
+		if self.last is None:
+			self.start = interval_start(ts, self.window)
+			self.energy = 0.0
+			self.last = (ts, power)
+			return
+		last_ts, last_power = self.last
+		if ts <= last_ts:
+			return
+		while ts >= self.start + self.window:
+			# Split the step at the boundary, interpolating the power there
+			boundary = self.start + self.window
+			edge = last_power + (power - last_power) * (boundary - last_ts) / (ts - last_ts)
+			self.energy += (last_power + edge) / 2 * (boundary - last_ts) / 3600
+			last_ts, last_power = boundary, edge
+			self.close()
+			self.start = boundary
+			self.energy = 0.0
+		self.energy += (last_power + power) / 2 * (ts - last_ts) / 3600
+		self.last = (ts, power)
+
+	def estimate(self):
+		last_ts, last_power = self.last
+		remaining = self.start + self.window - last_ts
+		projected = self.demand(self.energy + last_power * remaining / 3600)
+		estimate = {
+			"projected": round(projected, 3),
+			"window-kwh": round(self.energy / 1000, 4),
+			"remaining": round(remaining),
+		}
+		# Left out rather than measured from a peak that may be too low
+		if self.known(month_of(self.start)):
+			estimate.update({"peak": round(self.peak["peak"], 3), "margin": round(self.peak["peak"] - projected, 3)})
+		return estimate
+
+	def row(self, node, now):
+		# (stamp, node, estimate) at most every `every` seconds, else None
+		if self.last is None or (self.published is not None and now - self.published < self.every):
+			return None
+		self.published = now
+		return (now, node, self.estimate())
@@ -0,0 +1,90 @@
+# Derived metrics worked out in process from a cycle's combined readings,
+# rather than per phase inside the readers or downstream in EmonCMS process
+# lists.
+#
+# Each metric is declared as an output (node, key), the (node, key) inputs it
+# reads and a function called with the input values in order. Metrics run in
+# the order they were added, so a metric can take earlier outputs as inputs
+# (e.g. a site total of per phase consumption). An output is only recomputed
+# when one of its inputs changed since it was last worked out, otherwise the
+# cached value is published again. If any input is missing from the cycle,
+# e.g. a phase failed to read, the output is left out rather than published
+# from stale or partial data.
+#
+# Devices that are not read every cycle (see
+# emonlib.scheduler.AdaptiveInterval) can pass their last reading as held
+# data. Held values fill in for inputs that were not read this cycle, but an
+# output is only published when at least one of its inputs is fresh.
+#
+# Outputs are written into the cycle's row for their node (a dict or
+# emonlib.record.Record), or added as a new row stamped with the newest of
+# their inputs' stamps.
+
+MISSING = object()
+
+class Derived:
+
+	__slots__ = ("node", "key", "inputs", "func", "args", "value")
+
+	def __init__(self, node, key, inputs, func):
+		self.node = node
+		self.key = key
+		self.inputs = tuple(inputs)
+		self.func = func
+		self.args = None
+		self.value = None
+
+class DerivedMetrics:
+
+	def __init__(self):
+		self.metrics = []
+		self.stats = {"computed": 0, "reused": 0, "skipped": 0, "held": 0}
+
+	def __len__(self):
+		return len(self.metrics)
+
+	def add(self, node, key, inputs, func):
+		self.metrics.append(Derived(node, key, inputs, func))
+
+	def rows(self, rows, held=None):
+		# Inputs are looked up in each node's row directly and outputs written
+		# into it, rather than first flattening every value of the cycle
+		nodes = {}
+		stamps = {}
+		for ts, node, data in rows:
+			nodes[node] = data
+			stamps[node] = ts
+		held = held or {}
+		added = {}
+		for metric in self.metrics:
+			args = []
+			fresh = False
+			for node, k in metric.inputs:
+				v = nodes[node].get(k, MISSING) if node in nodes else MISSING
+				if v is MISSING:
+					v = held[node].get(k, MISSING) if node in held else MISSING
+				else:
+					fresh = True
+				args.append(v)
+			args = tuple(args)
+			if MISSING in args:
+				self.stats["skipped"] += 1
+				continue
+			if not fresh:
+				self.stats["held"] += 1
+				continue
+			if args != metric.args:
+				metric.value = metric.func(*args)
+				metric.args = args
+				self.stats["computed"] += 1
+			else:
+				self.stats["reused"] += 1
+			data = nodes.get(metric.node)
+			if data is None:
+				data = nodes[metric.node] = added[metric.node] = {}
+				input_stamps = [stamps.get(node) for node, k in metric.inputs if stamps.get(node) is not None]
+				stamps[metric.node] = max(input_stamps) if input_stamps else None
+			data[metric.key] = metric.value
+		if not added:
+			return rows
+		return rows + [(stamps[node], node, data) for node, data in added.items()]
@@ -0,0 +1,133 @@
+import asyncio
+import contextlib
+import json
+
+import aiohttp
+
+from emonlib.clock import wall_time
+from emonlib.record import json_items, encode
+
+# Async EmonCMS client shared by the collectors. One pooled keep-alive session
+# per process, JSON goes in the request body rather than the query string, and
+# all nodes from a cycle can be sent as a single input/bulk.json request.
+#
+# Rows passed to post_bulk() are (timestamp, node, data) tuples. Collectors
+# stamp each row with emonlib.clock.wall_time() when its reading is taken, so
+# queued, spooled or retried rows still land in the interval they were read
+# in. A timestamp of None means "now".
+#
+# Collectors post through send(). With a Spool attached, rows that cannot be
+# delivered because EmonCMS or the network is down are written to the spool
+# and replayed in rate limited bulk batches once a live post gets through.
+#
+# With a Metrics attached every request is timed under the "post" stage.
+#
+# Payloads are written straight to JSON text from each row's key fragments
+# (see emonlib.record) rather than built as lists of one key dicts first.
+
+class EmonCMSError(Exception):
+	pass
+
+def bulk_row(offset, node, data):
+	# [offset, "node", {"key":value}, {"key":value}, ...]
+	return "[" + ",".join([str(offset), json.dumps(node)] + ["{" + key + value + "}" for key, value in json_items(data)]) + "]"
+
+def bulk_payload(rows, now=None):
+	now = int(now if now is not None else wall_time())
+	bulk = []
+	for ts, node, data in rows:
+		offset = 0 if ts is None else int(round(ts)) - now
+		bulk.append(bulk_row(offset, node, data))
+	return {"data": "[" + ",".join(bulk) + "]", "time": str(now)}
+
+def unreachable(e):
+	# Only worth spooling if a later retry can succeed
+	if isinstance(e, aiohttp.ClientResponseError):
+		return e.status >= 500
+	return True
+
+class EmonCMS:
+
+	name = "emoncms"
+
+	def __init__(self, base_url, api_key, timeout=5, limit=4, verify=True, spool=None, metrics=None):
+		self.base_url = base_url.rstrip("/")
+		self.headers = {"Authorization": f"Bearer {api_key}"}
+		self.timeout = aiohttp.ClientTimeout(total=timeout)
+		self.limit = limit
+		self.verify = verify
+		self.spool = spool
+		self.metrics = metrics
+		self.replaying = None
+		self.session = None
+
+	async def __aenter__(self):
+		await self.open()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def open(self):
+		if self.session is None or self.session.closed:
+			connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60, ssl=None if self.verify else False)
+			self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+		return self.session
+
+	async def close(self):
+		if self.replaying is not None:
+			self.replaying.cancel()
+			await asyncio.gather(self.replaying, return_exceptions=True)
+			self.replaying = None
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
+	async def request(self, path, data=None, params=None):
+		session = await self.open()
+		with self.metrics.timer("post", path=path) if self.metrics is not None else contextlib.nullcontext():
+			async with session.post(f"{self.base_url}/{path}", data=data, params=params) as response:
+				response.raise_for_status()
+				text = await response.text()
+			# EmonCMS reports most failures with a 200 and a JSON error body
+			if text.startswith("{") and '"success":false' in text.replace(" ", ""):
+				raise EmonCMSError(text)
+		return text
+
+	async def post(self, node, data, ts=None):
+		form = {"node": node, "fulljson": encode(data)}
+		if ts is not None:
+			form["time"] = str(int(round(ts)))
+		return await self.request("input/post.json", data=form)
+
+	async def post_bulk(self, rows):
+		if not rows:
+			return None
+		return await self.request("input/bulk.json", data=bulk_payload(rows))
+
+	async def send(self, rows):
+		try:
+			await self.post_bulk(rows)
+		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+			if self.spool is not None and unreachable(e):
+				self.spool.append(rows)
+			raise
+		if self.spool is not None and len(self.spool) and self.replaying is None:
+			self.replaying = asyncio.create_task(self.replay())
+
+	async def replay(self):
+		try:
+			while len(self.spool):
+				batch = self.spool.batch()
+				if not batch:
+					break
+				await self.post_bulk([row for row_id, row in batch])
+				self.spool.remove([row_id for row_id, row in batch])
+				await asyncio.sleep(1 / self.spool.rate)
+		except (aiohttp.ClientError, asyncio.TimeoutError, EmonCMSError) as e:
+			print(f"Spool replay stopped with {len(self.spool)} rows left: {e}")
+		finally:
+			self.replaying = None
+
+	async def get_feed_value(self, feed_id):
+		return json.loads(await self.request("feed/value.json", params={"id": feed_id}))
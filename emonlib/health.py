@@ -0,0 +1,89 @@
+import asyncio
+import contextlib
+
+import aiohttp
+
+# Coalesced healthchecks.io reporting. Collectors call success() and error()
+# from the polling loop, which only records the event and never waits on the
+# network. A background task sends what was recorded once per window: at most
+# one ping if anything succeeded and one /log entry if anything failed, with
+# repeated errors merged into counts, e.g. "57 x RED meter: not connected".
+# With a Metrics attached each send is timed under the "health" stage.
+
+WINDOW = 60 #SECONDS
+
+class HealthReporter:
+
+	def __init__(self, url, window=WINDOW, timeout=5, metrics=None):
+		self.url = url.rstrip("/")
+		self.window = window
+		self.timeout = aiohttp.ClientTimeout(total=timeout)
+		self.metrics = metrics
+		self.session = None
+		self.task = None
+		self.successes = 0
+		self.errors = {}
+		self.stats = {"successes": 0, "errors": 0, "pings": 0, "logs": 0, "failed": 0}
+
+	async def __aenter__(self):
+		await self.open()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def open(self):
+		if self.session is None or self.session.closed:
+			self.session = aiohttp.ClientSession(timeout=self.timeout)
+		if self.task is None:
+			self.task = asyncio.create_task(self.run())
+		return self.session
+
+	async def close(self):
+		if self.task is not None:
+			self.task.cancel()
+			await asyncio.gather(self.task, return_exceptions=True)
+			self.task = None
+		if self.session is not None:
+			# Whatever happened since the last window still gets reported
+			await self.flush()
+			await self.session.close()
+			self.session = None
+
+	def success(self):
+		self.successes += 1
+		self.stats["successes"] += 1
+
+	def error(self, message):
+		self.errors[message] = self.errors.get(message, 0) + 1
+		self.stats["errors"] += 1
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.window)
+			await self.flush()
+
+	async def ping(self, url, status):
+		try:
+			with self.metrics.timer("health") if self.metrics is not None else contextlib.nullcontext():
+				async with self.session.post(url, json={"status": status}) as response:
+					response.raise_for_status()
+			return True
+		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+			self.stats["failed"] += 1
+			print(f"Health check error occurred: {e}")
+			return False
+
+	async def flush(self):
+		successes, errors = self.successes, self.errors
+		self.successes = 0
+		self.errors = {}
+		if not self.url or self.session is None:
+			return
+		if errors:
+			summary = "; ".join(message if count == 1 else f"{count} x {message}" for message, count in errors.items())
+			if await self.ping(f"{self.url}/log", summary):
+				self.stats["logs"] += 1
+		if successes:
+			if await self.ping(self.url, f"Success ({successes})"):
+				self.stats["pings"] += 1
@@ -0,0 +1,176 @@
+import asyncio
+import bisect
+import contextlib
+import os
+import time
+
+# In-process instrumentation for the collectors. Each stage of a cycle (read,
+# decode, post, health ...) is timed into a latency histogram labelled by
+# stage and device, and failures are counted by stage and exception type.
+#
+# The numbers are rendered in the Prometheus text format, served on a small
+# local HTTP endpoint (port=) and/or rewritten to a file every few seconds
+# (path=) for node_exporter's textfile collector or a plain `cat`.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) #SECONDS
+WRITE_EVERY = 15 #SECONDS BETWEEN FILE WRITES
+
+def escape(value):
+	return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def label_text(labels, extra=None):
+	pairs = list(labels) + ([extra] if extra else [])
+	if not pairs:
+		return ""
+	return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+class Histogram:
+
+	__slots__ = ("buckets", "counts", "sum", "count")
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		index = bisect.bisect_left(self.buckets, value)
+		if index < len(self.counts):
+			self.counts[index] += 1
+		self.sum += value
+		self.count += 1
+
+	def quantile(self, q):
+		# Upper bound of the bucket holding the q'th observation
+		if not self.count:
+			return None
+		rank = q * self.count
+		seen = 0
+		for bound, n in zip(self.buckets, self.counts):
+			seen += n
+			if seen >= rank:
+				return bound
+		return float("inf")
+
+class Metrics:
+
+	def __init__(self, prefix, port=None, host="127.0.0.1", path=None, every=WRITE_EVERY, buckets=BUCKETS):
+		self.prefix = prefix
+		self.port = port
+		self.host = host
+		self.path = path
+		self.every = every
+		self.buckets = tuple(sorted(buckets))
+		self.histograms = {}
+		self.errors = {}
+		self.server = None
+		self.writer = None
+
+	async def __aenter__(self):
+		await self.open()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def open(self):
+		if self.port and self.server is None:
+			try:
+				self.server = await asyncio.start_server(self.handle, self.host, self.port)
+			except OSError as e:
+				print(f"Metrics endpoint not started on {self.host}:{self.port}: {e}")
+		if self.path and self.writer is None:
+			self.writer = asyncio.create_task(self.run())
+
+	async def close(self):
+		if self.writer is not None:
+			self.writer.cancel()
+			await asyncio.gather(self.writer, return_exceptions=True)
+			self.writer = None
+			self.write()
+		if self.server is not None:
+			self.server.close()
+			await self.server.wait_closed()
+			self.server = None
+
+	def observe(self, stage, seconds, **labels):
+		key = (("stage", stage),) + tuple(labels.items())
+		histogram = self.histograms.get(key)
+		if histogram is None:
+			histogram = self.histograms[key] = Histogram(self.buckets)
+		histogram.observe(seconds)
+
+	def error(self, stage, e, **labels):
+		key = (("stage", stage), ("type", type(e).__name__)) + tuple(labels.items())
+		self.errors[key] = self.errors.get(key, 0) + 1
+
+	@contextlib.contextmanager
+	def timer(self, stage, **labels):
+		# Times the block whether or not it raises, and counts what it raised
+		start = time.perf_counter()
+		try:
+			yield
+		except Exception as e:
+			self.error(stage, e, **labels)
+			raise
+		finally:
+			self.observe(stage, time.perf_counter() - start, **labels)
+
+	def summary(self, q=0.99):
+		# {stage: (count, mean, q'th percentile bound)} summed over devices
+		stages = {}
+		for key, histogram in self.histograms.items():
+			stage = key[0][1]
+			merged = stages.get(stage)
+			if merged is None:
+				merged = stages[stage] = Histogram(self.buckets)
+			merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+			merged.sum += histogram.sum
+			merged.count += histogram.count
+		return {stage: (h.count, h.sum / h.count if h.count else 0.0, h.quantile(q)) for stage, h in stages.items()}
+
+	def render(self):
+		name = f"{self.prefix}_stage_seconds"
+		lines = [f"# HELP {name} Time spent in each collector stage.", f"# TYPE {name} histogram"]
+		for key, histogram in sorted(self.histograms.items()):
+			cumulative = 0
+			for bound, n in zip(self.buckets, histogram.counts):
+				cumulative += n
+				lines.append(f"{name}_bucket{label_text(key, ('le', bound))} {cumulative}")
+			lines.append(f"{name}_bucket{label_text(key, ('le', '+Inf'))} {histogram.count}")
+			lines.append(f"{name}_sum{label_text(key)} {histogram.sum:.6f}")
+			lines.append(f"{name}_count{label_text(key)} {histogram.count}")
+		name = f"{self.prefix}_errors_total"
+		lines += [f"# HELP {name} Failures by stage and exception type.", f"# TYPE {name} counter"]
+		for key, count in sorted(self.errors.items()):
+			lines.append(f"{name}{label_text(key)} {count}")
+		return "\n".join(lines) + "\n"
+
+	def write(self):
+		if not self.path:
+			return
+		# Written aside and renamed so readers never see a half written file
+		temp = f"{self.path}.tmp"
+		try:
+			with open(temp, "w") as f:
+				f.write(self.render())
+			os.replace(temp, self.path)
+		except OSError as e:
+			print(f"Error writing metrics to {self.path}: {e}")
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.every)
+			self.write()
+
+	async def handle(self, reader, writer):
+		try:
+			await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+			body = self.render().encode()
+			writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+			await writer.drain()
+		except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+			pass
+		finally:
+			writer.close()
@@ -0,0 +1,21 @@
+import math
+from datetime import datetime
+
+# Demand windows and billing months, shared by the live projection
+# (emonlib/demand.py) and the meter history tracking and tariffs in
+# amber-emoncms so the two always agree on where a window or month starts.
+#
+# Windows are aligned to whole multiples of the window since the epoch, as
+# InfluxDB GROUP BY time(30m) does, and count towards the local month they
+# start in.
+
+WINDOW = 30 * 60 #SECONDS
+
+def month_of(ts):
+	return datetime.fromtimestamp(ts).strftime("%Y-%m")
+
+def month_start(ts):
+	return datetime.fromtimestamp(ts).replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+def interval_start(ts, window=WINDOW):
+	return math.floor(ts / window) * window
@@ -0,0 +1,137 @@
+import json
+import math
+from array import array
+from collections.abc import Mapping
+
+# Compact sample records. A Schema is built once per device (the keys a
+# decode plan produces, in order) and every reading of that device is a
+# Record: the schema plus one array('d') of values, copied from a zeroed
+# template, instead of a fresh dict holding a float object per key. Keys
+# outside the schema (e.g. raw storage registers or derived outputs merged
+# in later) go in a small overflow dict.
+#
+# Records behave as mappings, so the publish filter, aggregator, derived
+# metrics and sinks take them and plain dicts alike. The wire encoders use the JSON key fragments
+# each schema pre-builds rather than encoding key names every time.
+
+FRAGMENTS = {}
+
+def fragment(k):
+	# '"key":' ready to be joined into JSON
+	text = FRAGMENTS.get(k)
+	if text is None:
+		text = FRAGMENTS[k] = json.dumps(k) + ":"
+	return text
+
+def number(v):
+	# json.dumps spelling for NaN and infinities, as before records
+	return repr(v) if math.isfinite(v) else json.dumps(v)
+
+def encode_value(v):
+	if isinstance(v, float):
+		return number(v)
+	if isinstance(v, bool):
+		return "true" if v else "false"
+	if isinstance(v, int):
+		return str(v)
+	return json.dumps(v, separators=(",", ":"), default=plain)
+
+def plain(obj):
+	# json.dumps default= for Records and the numeric types it does not know
+	if isinstance(obj, Mapping):
+		return dict(obj.items())
+	return float(obj)
+
+class Schema:
+
+	__slots__ = ("keys", "index", "fragments", "template")
+
+	def __init__(self, keys):
+		self.keys = tuple(keys)
+		self.index = {k: i for i, k in enumerate(self.keys)}
+		self.fragments = tuple(fragment(k) for k in self.keys)
+		self.template = array("d", bytes(8 * len(self.keys)))
+
+	def __len__(self):
+		return len(self.keys)
+
+	def record(self):
+		return Record(self, self.template[:])
+
+class Record(Mapping):
+
+	__slots__ = ("schema", "values", "extra")
+
+	def __init__(self, schema, values, extra=None):
+		self.schema = schema
+		self.values = values
+		self.extra = extra
+
+	def __repr__(self):
+		return f"Record({dict(self.items())})"
+
+	def __len__(self):
+		return len(self.schema.keys) + (len(self.extra) if self.extra else 0)
+
+	def __iter__(self):
+		yield from self.schema.keys
+		if self.extra:
+			yield from self.extra
+
+	def __getitem__(self, k):
+		i = self.schema.index.get(k)
+		if i is not None:
+			return self.values[i]
+		if self.extra and k in self.extra:
+			return self.extra[k]
+		raise KeyError(k)
+
+	def __setitem__(self, k, v):
+		i = self.schema.index.get(k)
+		if i is not None and isinstance(v, (int, float)) and not isinstance(v, bool):
+			self.values[i] = v
+			return
+		if i is not None:
+			# A schema key holding something that is not a number this time
+			raise TypeError(f"{k} must be a number, got {v!r}")
+		if self.extra is None:
+			self.extra = {}
+		self.extra[k] = v
+
+	def get(self, k, default=None):
+		i = self.schema.index.get(k)
+		if i is not None:
+			return self.values[i]
+		if self.extra:
+			return self.extra.get(k, default)
+		return default
+
+	def items(self):
+		yield from zip(self.schema.keys, self.values)
+		if self.extra:
+			yield from self.extra.items()
+
+	def update(self, other=(), **kwargs):
+		for k, v in (other.items() if hasattr(other, "items") else other):
+			self[k] = v
+		for k, v in kwargs.items():
+			self[k] = v
+
+	def copy(self):
+		return Record(self.schema, self.values[:], dict(self.extra) if self.extra else None)
+
+	def json_items(self):
+		# ('"key":', value text) pairs using the schema's pre-built fragments
+		yield from zip(self.schema.fragments, map(number, self.values))
+		if self.extra:
+			for k, v in self.extra.items():
+				yield fragment(k), encode_value(v)
+
+def json_items(data):
+	if isinstance(data, Record):
+		return data.json_items()
+	return ((fragment(k), encode_value(v)) for k, v in data.items())
+
+def encode(data):
+	# Compact JSON object for a Record or dict
+	return "{" + ",".join(key + value for key, value in json_items(data)) + "}"
@@ -0,0 +1,169 @@
+import asyncio
+import math
+import time
+
+# Wall clock aligned scheduler. Ticks fall on whole multiples of the interval
+# (plus an optional offset) since the epoch, so a 5 second ticker fires at
+# :00, :05, :10 ... on every box. The next tick is always worked out from the
+# clock, never by sleeping a fixed time after the work, so the period does
+# not drift with the cycle time.
+#
+# If a cycle overruns one or more ticks they are not queued up: the missed
+# ticks are merged into a single tick that fires straight away, or skipped
+# entirely with skip=True.
+#
+# An interval of 0 free runs: every tick fires as soon as it is waited for,
+# for collectors that sample as fast as the devices answer.
+#
+# AdaptiveInterval paces one device on top of the ticker. Its interval drops
+# straight to the minimum when a watched value moves faster than fast units
+# per second (a cloud edge, a battery switching mode), grows by backoff each
+# time the values are flat (moved by no more than flat since the last read),
+# and jumps to the maximum while the device reports an idle state, e.g. an
+# inverter that is off or sleeping at night.
+
+#
+# Backoff spaces out retries of something that keeps failing, from initial
+# doubling up to maximum, and is reset by the first success.
+
+FAST = 100 #UNITS PER SECOND, E.G. W/S
+FLAT = 10 #UNITS BETWEEN READS
+BACKOFF = 2
+
+class Ticker:
+
+	def __init__(self, interval, offset=0, skip=False):
+		if interval < 0:
+			raise ValueError("Ticker interval must not be below 0")
+		self.interval = interval
+		self.offset = offset
+		self.skip = skip
+		self.next = None
+		self.stats = {"ticks": 0, "overruns": 0, "missed": 0, "lateness_last_ms": 0.0, "lateness_max_ms": 0.0}
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		return await self.wait()
+
+	def boundary_after(self, now):
+		return (math.floor((now - self.offset) / self.interval) + 1) * self.interval + self.offset
+
+	async def wait(self):
+		# Returns the wall clock time of the tick that fired
+		if not self.interval:
+			self.stats["ticks"] += 1
+			await asyncio.sleep(0)
+			return time.time()
+		now = time.time()
+		if self.next is None:
+			self.next = self.boundary_after(now)
+		elif now >= self.next + self.interval:
+			missed = math.floor((now - self.next) / self.interval)
+			self.stats["overruns"] += 1
+			self.stats["missed"] += missed
+			if self.skip:
+				self.next = self.boundary_after(now)
+			else:
+				self.next += missed * self.interval
+		tick = self.next
+		delay = tick - time.time()
+		if delay > 0:
+			await asyncio.sleep(delay)
+		lateness = (time.time() - tick) * 1000
+		self.stats["ticks"] += 1
+		self.stats["lateness_last_ms"] = round(lateness, 1)
+		self.stats["lateness_max_ms"] = round(max(self.stats["lateness_max_ms"], lateness), 1)
+		self.next = tick + self.interval
+		return tick
+
+class AdaptiveInterval:
+
+	def __init__(self, minimum, maximum, keys, fast=FAST, flat=FLAT, backoff=BACKOFF, idle=None):
+		if minimum < 0 or maximum < minimum:
+			raise ValueError("Adaptive interval needs 0 <= minimum <= maximum")
+		self.minimum = minimum
+		self.maximum = maximum
+		self.keys = tuple(keys)
+		self.fast = fast
+		self.flat = flat
+		self.backoff = backoff
+		# Idle states, {key: values}, e.g. {"status": (1, 2)}
+		self.idle = idle or {}
+		self.interval = minimum
+		self.next = 0.0
+		self.read = None
+		self.last = {}
+		self.stats = {"due": 0, "held": 0, "fast": 0, "flat": 0, "idle": 0}
+
+	def due(self, now=None):
+		now = time.monotonic() if now is None else now
+		# Half the minimum of slack, so reads land on the tick they are due on
+		# rather than the one after
+		if now >= self.next - self.minimum / 2:
+			self.stats["due"] += 1
+			return True
+		self.stats["held"] += 1
+		return False
+
+	def until(self, now=None):
+		# Seconds until due, 0 when due now
+		now = time.monotonic() if now is None else now
+		return max(0.0, self.next - self.minimum / 2 - now)
+
+	def update(self, data, now=None):
+		# Works out the interval to the next read from a successful one
+		now = time.monotonic() if now is None else now
+		change = 0.0
+		for k in self.keys:
+			v = data.get(k)
+			last = self.last.get(k)
+			if isinstance(v, (int, float)) and isinstance(last, (int, float)):
+				change = max(change, abs(v - last))
+			self.last[k] = v
+		elapsed = None if self.read is None else now - self.read
+		self.read = now
+		if any(data.get(k) in values for k, values in self.idle.items()):
+			self.interval = self.maximum
+			self.stats["idle"] += 1
+		elif elapsed is None:
+			self.interval = self.minimum
+		elif elapsed > 0 and change / elapsed >= self.fast:
+			self.interval = self.minimum
+			self.stats["fast"] += 1
+		elif change <= self.flat:
+			step = self.interval * self.backoff if self.interval else 1
+			self.interval = min(self.maximum, max(self.minimum, step))
+			self.stats["flat"] += 1
+		self.next = now + self.interval
+		return self.interval
+
+class Backoff:
+
+	def __init__(self, initial, maximum, factor=BACKOFF):
+		self.initial = initial
+		self.maximum = maximum
+		self.factor = factor
+		self.failures = 0
+		self.retry_at = 0.0
+		self.stats = {"failures": 0, "recoveries": 0}
+
+	def failure(self, now=None):
+		# Returns the delay before the next attempt
+		now = time.monotonic() if now is None else now
+		delay = min(self.maximum, self.initial * self.factor ** self.failures)
+		self.failures += 1
+		self.retry_at = now + delay
+		self.stats["failures"] += 1
+		return delay
+
+	def success(self):
+		if self.failures:
+			self.stats["recoveries"] += 1
+		self.failures = 0
+		self.retry_at = 0.0
+
+	def until(self, now=None):
+		now = time.monotonic() if now is None else now
+		return max(0.0, self.retry_at - now)
@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import inspect
+import time
+
+# Bounded hand-off between the readers and a sink. Readers put() whole cycles
+# of rows without waiting, a fixed pool of workers sends them. When the queue
+# is full the overload policy decides what gives:
+#   DROP_OLDEST - the oldest queued cycle is discarded
+#   MERGE       - the new cycle is folded into the newest queued one, keeping
+#                 the latest values per node
+#
+# Coalescer sits in front of a queue (or Outputs) for readers that publish
+# device by device rather than in whole cycles: rows put within linger
+# seconds of the first go out as a single put(), so devices that finish close
+# together still share one bulk post and none waits on a slow one for longer
+# than the linger.
+
+LINGER = 0.05 #SECONDS
+
+DROP_OLDEST = "drop_oldest"
+MERGE = "merge"
+
+def merge_rows(older, newer):
+	merged = {}
+	for ts, node, data in older + newer:
+		if node in merged:
+			merged[node] = (ts, node, {**merged[node][2], **data})
+		else:
+			merged[node] = (ts, node, data)
+	return list(merged.values())
+
+class PostQueue:
+
+	def __init__(self, send, maxsize=30, workers=2, policy=DROP_OLDEST, on_error=None):
+		self.send = send
+		self.maxsize = maxsize
+		self.workers = workers
+		self.policy = policy
+		self.on_error = on_error
+		self.items = collections.deque()
+		self.wakeup = asyncio.Event()
+		self.tasks = []
+		self.in_flight = 0
+		self.stats = {"enqueued": 0, "sent": 0, "failed": 0, "dropped": 0, "merged": 0, "max_depth": 0}
+		self.latency = {"count": 0, "total": 0.0, "last": 0.0, "max": 0.0}
+
+	async def __aenter__(self):
+		self.start()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	def start(self):
+		if not self.tasks:
+			self.tasks = [asyncio.create_task(self._worker()) for i in range(self.workers)]
+
+	async def close(self, timeout=5):
+		# Give queued cycles a chance to go out before the workers stop
+		deadline = time.monotonic() + timeout
+		while (self.items or self.in_flight) and time.monotonic() < deadline:
+			await asyncio.sleep(0.05)
+		for task in self.tasks:
+			task.cancel()
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+
+	def depth(self):
+		return len(self.items)
+
+	def put(self, rows):
+		if not rows:
+			return
+		self.stats["enqueued"] += 1
+		if len(self.items) >= self.maxsize:
+			if self.policy == MERGE:
+				self.items[-1] = merge_rows(self.items[-1], rows)
+				self.stats["merged"] += 1
+				return
+			self.items.popleft()
+			self.stats["dropped"] += 1
+		self.items.append(rows)
+		self.stats["max_depth"] = max(self.stats["max_depth"], len(self.items))
+		self.wakeup.set()
+
+	def metrics(self):
+		count = self.latency["count"]
+		return {
+			"depth": len(self.items),
+			"in_flight": self.in_flight,
+			**self.stats,
+			"latency_last_ms": round(self.latency["last"] * 1000, 1),
+			"latency_avg_ms": round(self.latency["total"] / count * 1000, 1) if count else 0.0,
+			"latency_max_ms": round(self.latency["max"] * 1000, 1),
+		}
+
+	async def _worker(self):
+		while True:
+			while not self.items:
+				self.wakeup.clear()
+				await self.wakeup.wait()
+			rows = self.items.popleft()
+			self.in_flight += 1
+			start = time.monotonic()
+			try:
+				await self.send(rows)
+				self.stats["sent"] += 1
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				self.stats["failed"] += 1
+				if self.on_error is not None:
+					try:
+						result = self.on_error(e, rows)
+						if inspect.isawaitable(result):
+							await result
+					except Exception as error:
+						print(f"Error handling failed post: {error}")
+			finally:
+				self.in_flight -= 1
+				elapsed = time.monotonic() - start
+				self.latency["count"] += 1
+				self.latency["total"] += elapsed
+				self.latency["last"] = elapsed
+				self.latency["max"] = max(self.latency["max"], elapsed)
+
+class Coalescer:
+
+	def __init__(self, target, linger=LINGER):
+		self.target = target
+		self.linger = linger
+		self.rows = []
+		self.handle = None
+		self.stats = {"rows": 0, "puts": 0}
+
+	def put(self, rows):
+		if not rows:
+			return
+		self.rows.extend(rows)
+		self.stats["rows"] += len(rows)
+		if self.handle is None:
+			self.handle = asyncio.get_running_loop().call_later(self.linger, self.flush)
+
+	def flush(self):
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+		rows, self.rows = self.rows, []
+		if rows:
+			self.stats["puts"] += 1
+			self.target.put(rows)
+
+	def depth(self):
+		return self.target.depth()
+
+	def metrics(self):
+		return self.target.metrics()
@@ -0,0 +1,273 @@
+import math
+import json
+import asyncio
+
+import aiohttp
+
+from emonlib.clock import wall_time
+from emonlib.record import plain
+from emonlib.sender import PostQueue, DROP_OLDEST
+
+try:
+	import paho.mqtt.client as mqtt
+except ImportError:
+	mqtt = None
+
+# Output sinks. A sink is anything with async open(), close() and send(rows),
+# where rows are (timestamp, node, data) tuples; EmonCMS is one. Outputs fans
+# each cycle out to several sinks at once, each behind its own PostQueue, so
+# a slow or unreachable sink only backs up its own queue.
+#
+#   InfluxSink - InfluxDB 1.x line protocol over HTTP, buffered and written in
+#                batches of batch_size lines or every flush_interval seconds.
+#                By default in the layout telegraf's MQTT input already writes
+#                (mqtt_consumer, a topic=<node>/<key> tag and a value field),
+#                which the dashboards and amber-demand-charge.py query, or
+#                layout=FIELDS for one line per node with a field per key.
+#                topic_prefix is put in front of <node>/<key> to match the
+#                base topic telegraf sees, e.g. "emon/"
+#   MQTTSink   - one JSON message per node on <topic>/<node> with a "time"
+#                key, the format the EmonCMS MQTT input reads, needs paho-mqtt
+
+TOPICS = "topics" #ONE LINE PER VALUE, topic=<node>/<key> value=<value>
+FIELDS = "fields" #ONE LINE PER NODE, node=<node> <key>=<value>,...
+MEASUREMENT = "mqtt_consumer"
+TOPIC_PREFIX = "" #E.G. "emon/" WHEN TELEGRAF'S TOPIC TAGS CARRY THE EMONCMS MQTT BASE TOPIC
+BATCH_SIZE = 5000 #LINES
+FLUSH_INTERVAL = 5 #SECONDS
+MAX_LINES = 200000 #BUFFERED WHILE INFLUXDB IS DOWN, OLDEST DROPPED FIRST
+TOPIC = "emon"
+
+def escape_tag(value):
+	return str(value).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+def field_value(v):
+	if isinstance(v, bool):
+		return "true" if v else "false"
+	if isinstance(v, (int, float)):
+		# Always floats so a value that is sometimes whole does not clash
+		# with the field's type in InfluxDB
+		return repr(float(v)) if math.isfinite(v) else None
+	return '"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+class InfluxSink:
+
+	name = "influxdb"
+
+	def __init__(self, url, database, measurement=MEASUREMENT, layout=TOPICS, topic_prefix=TOPIC_PREFIX, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_lines=MAX_LINES, username=None, password=None, timeout=5):
+		self.url = url.rstrip("/")
+		self.database = database
+		if layout not in (TOPICS, FIELDS):
+			raise ValueError(f"Unknown InfluxDB layout {layout}")
+		self.measurement = escape_tag(measurement)
+		self.layout = layout
+		self.topic_prefix = topic_prefix
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_lines = max_lines
+		self.auth = aiohttp.BasicAuth(username, password or "") if username else None
+		self.timeout = aiohttp.ClientTimeout(total=timeout)
+		self.session = None
+		self.task = None
+		self.lock = asyncio.Lock()
+		self.lines = []
+		self.prefixes = {}
+		self.fields = {}
+		self.stats = {"lines": 0, "writes": 0, "written": 0, "failed": 0, "dropped": 0}
+
+	async def __aenter__(self):
+		await self.open()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def open(self):
+		if self.session is None or self.session.closed:
+			self.session = aiohttp.ClientSession(timeout=self.timeout, auth=self.auth)
+		if self.task is None:
+			self.task = asyncio.create_task(self.run())
+
+	async def close(self):
+		if self.task is not None:
+			self.task.cancel()
+			await asyncio.gather(self.task, return_exceptions=True)
+			self.task = None
+		if self.session is not None:
+			try:
+				await self.flush()
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				print(f"Error writing to InfluxDB, {len(self.lines)} lines lost: {e}")
+			await self.session.close()
+			self.session = None
+
+	def topic_lines(self, stamp, node, data):
+		# Only numbers, the value field telegraf writes is a float
+		lines = []
+		for k, v in data.items():
+			if not isinstance(v, (int, float)):
+				continue
+			value = field_value(float(v))
+			if value is None:
+				continue
+			prefix = self.prefixes.get((node, k))
+			if prefix is None:
+				prefix = self.prefixes[(node, k)] = f"{self.measurement},topic={escape_tag(f'{self.topic_prefix}{node}/{k}')} value="
+			lines.append(f"{prefix}{value} {stamp}")
+		return lines
+
+	def field_line(self, stamp, node, data):
+		prefix = self.prefixes.get(node)
+		if prefix is None:
+			prefix = self.prefixes[node] = f"{self.measurement},node={escape_tag(node)} "
+		fields = []
+		for k, v in data.items():
+			value = field_value(v)
+			if value is None:
+				continue
+			key = self.fields.get(k)
+			if key is None:
+				key = self.fields[k] = escape_tag(k) + "="
+			fields.append(key + value)
+		if not fields:
+			return []
+		return [f"{prefix}{','.join(fields)} {stamp}"]
+
+	def lines_for(self, ts, node, data):
+		stamp = int((wall_time() if ts is None else ts) * 1000)
+		if self.layout == TOPICS:
+			return self.topic_lines(stamp, node, data)
+		return self.field_line(stamp, node, data)
+
+	async def send(self, rows):
+		for ts, node, data in rows:
+			lines = self.lines_for(ts, node, data)
+			self.lines.extend(lines)
+			self.stats["lines"] += len(lines)
+		if len(self.lines) > self.max_lines:
+			self.stats["dropped"] += len(self.lines) - self.max_lines
+			del self.lines[:len(self.lines) - self.max_lines]
+		if len(self.lines) >= self.batch_size:
+			await self.flush()
+
+	async def flush(self):
+		async with self.lock:
+			while self.lines:
+				batch = self.lines[:self.batch_size]
+				try:
+					async with self.session.post(f"{self.url}/write", params={"db": self.database, "precision": "ms"}, data="\n".join(batch).encode()) as response:
+						response.raise_for_status()
+				except (aiohttp.ClientError, asyncio.TimeoutError):
+					self.stats["failed"] += 1
+					raise
+				del self.lines[:len(batch)]
+				self.stats["writes"] += 1
+				self.stats["written"] += len(batch)
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			try:
+				await self.flush()
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				print(f"Error writing to InfluxDB, {len(self.lines)} lines held: {e}")
+
+class MQTTSink:
+
+	name = "mqtt"
+
+	def __init__(self, host, port=1883, topic=TOPIC, qos=0, retain=False, username=None, password=None, client_id=""):
+		self.host = host
+		self.port = port
+		self.topic = topic.rstrip("/")
+		self.qos = qos
+		self.retain = retain
+		self.username = username
+		self.password = password
+		self.client_id = client_id
+		self.client = None
+		self.stats = {"published": 0, "failed": 0}
+
+	async def __aenter__(self):
+		await self.open()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def open(self):
+		if mqtt is None:
+			raise RuntimeError("MQTT output needs paho-mqtt (pip install paho-mqtt)")
+		if self.client is not None:
+			return
+		if hasattr(mqtt, "CallbackAPIVersion"):
+			self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id)
+		else:
+			self.client = mqtt.Client(client_id=self.client_id)
+		if self.username:
+			self.client.username_pw_set(self.username, self.password)
+		# paho reconnects and publishes from its own thread
+		self.client.connect_async(self.host, self.port)
+		self.client.loop_start()
+
+	async def close(self):
+		if self.client is not None:
+			self.client.disconnect()
+			self.client.loop_stop()
+			self.client = None
+
+	async def send(self, rows):
+		for ts, node, data in rows:
+			payload = json.dumps({"time": wall_time() if ts is None else ts, **data}, separators=(",", ":"), default=plain)
+			result = self.client.publish(f"{self.topic}/{node}", payload, qos=self.qos, retain=self.retain)
+			if result.rc == mqtt.MQTT_ERR_SUCCESS:
+				self.stats["published"] += 1
+			else:
+				self.stats["failed"] += 1
+
+class Outputs:
+
+	def __init__(self, sinks, maxsize=30, workers=2, policy=DROP_OLDEST, on_error=None):
+		self.sinks = list(sinks)
+		self.maxsize = maxsize
+		self.workers = workers
+		self.policy = policy
+		self.on_error = on_error
+		self.queues = {}
+
+	async def __aenter__(self):
+		await self.open()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	def handler(self, name):
+		if self.on_error is None:
+			return None
+		return lambda e, rows: self.on_error(name, e, rows)
+
+	async def open(self):
+		for sink in self.sinks:
+			name = getattr(sink, "name", type(sink).__name__)
+			await sink.open()
+			queue = self.queues[name] = PostQueue(sink.send, maxsize=self.maxsize, workers=self.workers, policy=self.policy, on_error=self.handler(name))
+			queue.start()
+
+	async def close(self):
+		# Queues drain before their sinks close
+		for queue in self.queues.values():
+			await queue.close()
+		for sink in self.sinks:
+			await sink.close()
+		self.queues = {}
+
+	def put(self, rows):
+		for queue in self.queues.values():
+			queue.put(rows)
+
+	def depth(self):
+		return max((queue.depth() for queue in self.queues.values()), default=0)
+
+	def metrics(self):
+		return {name: queue.metrics() for name, queue in self.queues.items()}
@@ -0,0 +1,59 @@
+import json
+import sqlite3
+
+from emonlib.clock import wall_time
+from emonlib.record import plain
+
+# Local store-and-forward spool for samples that could not be delivered.
+# Rows are kept in an SQLite database in WAL mode, one row per node and
+# timestamp, so spooling or replaying the same sample twice is harmless: the
+# replay posts it again with the same timestamp and EmonCMS overwrites the
+# same datapoint. Nothing here is touched on the live path while the spool is
+# empty.
+
+MAX_ROWS = 500000
+REPLAY_BATCH = 250 #ROWS PER BULK REQUEST
+REPLAY_RATE = 2 #BULK REQUESTS PER SECOND
+
+class Spool:
+
+	def __init__(self, path, max_rows=MAX_ROWS, batch_size=REPLAY_BATCH, rate=REPLAY_RATE):
+		self.path = path
+		self.max_rows = max_rows
+		self.batch_size = batch_size
+		self.rate = rate
+		self.db = sqlite3.connect(path)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL NOT NULL, node TEXT NOT NULL, data TEXT NOT NULL, UNIQUE(node, time) ON CONFLICT REPLACE)")
+		self.db.commit()
+		self.count = self.db.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+		self.stats = {"spooled": 0, "replayed": 0, "evicted": 0}
+
+	def __len__(self):
+		return self.count
+
+	def close(self):
+		self.db.close()
+
+	def append(self, rows):
+		now = wall_time()
+		with self.db:
+			self.db.executemany("INSERT INTO samples (time, node, data) VALUES (?, ?, ?)", [(now if ts is None else ts, node, json.dumps(data, default=plain)) for ts, node, data in rows])
+			self.count = self.db.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+			if self.count > self.max_rows:
+				evict = self.count - self.max_rows
+				self.db.execute("DELETE FROM samples WHERE id IN (SELECT id FROM samples ORDER BY id LIMIT ?)", (evict,))
+				self.stats["evicted"] += evict
+				self.count = self.max_rows
+		self.stats["spooled"] += len(rows)
+
+	def batch(self):
+		cursor = self.db.execute("SELECT id, time, node, data FROM samples ORDER BY id LIMIT ?", (self.batch_size,))
+		return [(row_id, (ts, node, json.loads(data))) for row_id, ts, node, data in cursor]
+
+	def remove(self, ids):
+		with self.db:
+			self.db.executemany("DELETE FROM samples WHERE id = ?", [(row_id,) for row_id in ids])
+		self.count = max(0, self.count - len(ids))
+		self.stats["replayed"] += len(ids)
@@ -1,42 +1,66 @@
+import os
+import sys
 import asyncio
 import time
 import requests
-import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from emonlib.emoncms import EmonCMS
+from emonlib.scheduler import Ticker
+from emonlib.spool import Spool
+from emonlib.deadband import PublishFilter
+from emonlib.metrics import Metrics
+from emonlib.sinks import Outputs, InfluxSink, MQTTSink
+from emonlib.clock import wall_time
 
 HEALTHCHECK_URL = "YOUR HEALTHCHECK URL"
 EMONCMS_BASE_URL = "http:// YOUR EMONCMS OR IP"
 INTERVAL = 2
 EMONCMS_API_KEY = "YOUR EMONCMS API-KEY"
-EMONCMS_URL = f"{EMONCMS_BASE_URL}/input/post?"
-EMONCMS_HEADERS = {"Authorization": f"Bearer {EMONCMS_API_KEY}"}
+DEADBAND_KEYS = {"power": (5, 0), "temperature": (0.5, 0), "rssi": (3, 0)} #(ABSOLUTE, RELATIVE)
+HEARTBEAT = 60 #SECONDS
+SPOOL_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".spool.db"
+METRICS_PORT = 9102 #PROMETHEUS TEXT ON http://127.0.0.1:9102/, None DISABLES
+METRICS_FILE = None #OR A PATH THE SAME TEXT IS WRITTEN TO EVERY 15 SECONDS
+INFLUXDB_URL = None #E.G. "http://localhost:8086" TO WRITE STRAIGHT INTO INFLUXDB AS WELL
+INFLUXDB_DATABASE = "telegraf"
+INFLUXDB_TOPIC_PREFIX = "" #IN FRONT OF <NODE>/<KEY>, E.G. "emon/" IF TELEGRAF'S TOPICS CARRY THE EMONCMS MQTT BASE TOPIC
+MQTT_HOST = None #E.G. "localhost" TO PUBLISH emon/<node> JSON AS WELL, NEEDS paho-mqtt
 
 SHELLEY_DEVICE = "http://10.0.2.36/" #REPLACE WITH YOUR SHELLY DEVICE IP ADDRESS
 SHELLEY_SETTINGS = "settings"
 SHELLEY_STATUS = "status"
 
 session = requests.Session()
+publish_filter = PublishFilter(heartbeat=HEARTBEAT, keys=DEADBAND_KEYS)
+metrics = Metrics("hotwater", port=METRICS_PORT, path=METRICS_FILE)
+emoncms = EmonCMS(EMONCMS_BASE_URL, EMONCMS_API_KEY, timeout=2, spool=Spool(SPOOL_PATH), metrics=metrics)
+
+sinks = [emoncms]
+if INFLUXDB_URL:
+	sinks.append(InfluxSink(INFLUXDB_URL, INFLUXDB_DATABASE, topic_prefix=INFLUXDB_TOPIC_PREFIX))
+if MQTT_HOST:
+	sinks.append(MQTTSink(MQTT_HOST))
+outputs = Outputs(sinks, on_error=lambda name, e, rows: print(f"Error posting data to {name}: {e}"))
 
 def check_healthcheck():
-	response = session.post(HEALTHCHECK_URL, timeout=1)
+	with metrics.timer("health"):
+		response = session.post(HEALTHCHECK_URL, timeout=1)
 	response.raise_for_status()
 	if response.status_code != 200:
 		print("Health check connection failure")
 		return False
 	return True
 
-def post_to_emoncms(device_data, device_name):
+async def post_to_emoncms(device_data, device_name, stamp=None):
 	relay = int(device_data['relays'][0]['ison'])
 	power = float(device_data['meters'][0]['power'])
 	temperature = float(device_data['temperature'])
 	rssi = int(device_data['wifi_sta']['rssi'])
 
 	api_data = {"relay": relay, "power": power, "temperature": temperature, "rssi": rssi}
-	json_data = json.dumps(api_data, separators=(',', ':'))
-
-	response = session.post(EMONCMS_URL + f"&node={device_name}&fulljson={json_data}", headers=EMONCMS_HEADERS, timeout=2)
-	response.raise_for_status()
-	if response.status_code != 200:
-		print(f"Error posting data to EmonCMS: {response.content}")
+	api_data = publish_filter.filter(device_name, api_data)
+	if api_data:
+		outputs.put([(stamp, device_name, api_data)])
 
 def get_device_info(str):
 	if str == "data":
@@ -50,37 +74,40 @@ async def update_info_and_display():
 	try:
 		start_time = time.time()
 
-		# Get the device name
-		device_name = get_device_info("name")
+		with metrics.timer("read", device="shelly"):
+			# Get the device name
+			device_name = get_device_info("name")
 
-		# Get the device data
-		device_data = get_device_info("data")
+			# Get the device data, stamped when it was read
+			start = wall_time()
+			device_data = get_device_info("data")
+			stamp = (start + wall_time()) / 2
 
 		# Post the data to emoncms
-		post_to_emoncms(device_data, device_name)
+		await post_to_emoncms(device_data, device_name, stamp)
 
 		# Check the healthcheck
 		if not check_healthcheck():
 			return
 
-		# Calculate the time taken to run the code
-		time_taken = time.time() - start_time
-		#print(f"Time taken: {time_taken:.2f} seconds")
+		metrics.observe("cycle", time.time() - start_time)
 
-	except requests.exceptions.Timeout:
+	except requests.exceptions.Timeout as e:
+		metrics.error("cycle", e)
 		print("Connection Failure Exception")
 		exit()
 
 	except Exception as e:
+		metrics.error("cycle", e)
 		print(f"Error updating info: {e}")
 		
 async def main():
 	print("Starting up...")
-	await update_info_and_display()
-	print("Running.")
-	while True:
-		await asyncio.sleep(INTERVAL)
+	async with metrics, outputs:
 		await update_info_and_display()
+		print("Running.")
+		async for tick in Ticker(INTERVAL):
+			await update_info_and_display()
 
 if __name__ == "__main__":
 	asyncio.run(main())
@@ -1,11 +1,14 @@
+import os
+import sys
 import asyncio
-import json
 import requests
 import time
 import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from emonlib.emoncms import EmonCMS
+from emonlib.scheduler import Ticker
 
 EMONCMS_API_KEY = "YOUR EMONCMS IP ADDRESS"
-EMONCMS_HEADERS = {"Authorization": f"Bearer {EMONCMS_API_KEY}"}
 EMONCMS_SERVER_IP = "EMONCMS IP ADDRESS"
 SHELLY_BASE_URL = "http://10.0.2.36/" # YOUR SHELLY DEVICE IP ADDRESS
 INTERVAL = 60 #SECONDS
@@ -19,26 +22,23 @@ HOT_WATER_CONSUMPTION = 3600 #WATTS
 HEALTHCHECK_ID = "YOUR HEALTHCHECK ID"
 
 session = requests.Session()
+emoncms = EmonCMS(f"http://{EMONCMS_SERVER_IP}", EMONCMS_API_KEY)
 
-def get_feed_value(feed_id):
-	#url = f"{EMONCMS_BASE_URL}{feed_id}"
-	url = f"http://{EMONCMS_SERVER_IP}/feed/value.json?id={feed_id}"
-	response = session.post(url, headers=EMONCMS_HEADERS)
-	response.raise_for_status()
-	if response.status_code != 200:
-		print(f"Error getting data from EmonCMS: {response.content}")
-	return float(response.json())
+async def get_feed_value(feed_id):
+	return float(await emoncms.get_feed_value(feed_id))
+
+async def get_battery_feeds():
+	return sum(await asyncio.gather(*[get_feed_value(battery_id) for battery_id in BATTERY_FEED_ID])) * -1
 
-def get_grid_battery_status(x):
-	battery_status = sum([get_feed_value(battery_id) for battery_id in BATTERY_FEED_ID]) * -1
-	grid_status = get_feed_value(GRID_FEED_ID)
+async def get_grid_battery_status(x):
+	battery_status, grid_status = await asyncio.gather(get_battery_feeds(), get_feed_value(GRID_FEED_ID))
 	combined = grid_status + battery_status
 	if x != 0:
 		print(f"Grid status: {grid_status}, Battery status: {battery_status}, Total Status: {combined}")
 	return grid_status + battery_status
 
-def get_battery_status():
-	battery_status = sum([get_feed_value(battery_id) for battery_id in BATTERY_FEED_ID]) * -1
+async def get_battery_status():
+	battery_status = await get_battery_feeds()
 	# return "1" if discharging - return "0" if not discharging
 	if battery_status > 0:
 		battery_status = 1
@@ -47,7 +47,7 @@ def get_battery_status():
 	print(f"Battery discharging: {battery_status}")
 	return battery_status
 
-def set_hot_water(is_hot_water_on):
+async def set_hot_water(is_hot_water_on):
 	set_health_status()
 	current_hot_water_status = get_hot_water_status(1)
 	if current_hot_water_status == is_hot_water_on:
@@ -65,10 +65,10 @@ def get_hot_water_status(x):
 		print(f"Hot water status: {status}")
 	return status
 
-def get_forced_status():
+async def get_forced_status():
 	force_on = 0
 	if datetime.datetime.now().hour >= 13 and datetime.datetime.now().hour < 16:
-		consumption_today = get_feed_value(HOT_WATER_TODAY)
+		consumption_today = await get_feed_value(HOT_WATER_TODAY)
 		if consumption_today < 16:
 			force_on = 1
 	print(f"Forced Status: {force_on}")
@@ -78,8 +78,8 @@ def get_schedule_status():
 	schedule = 1 if datetime.datetime.now().hour >= 8 and datetime.datetime.now().hour < 16 else 0
 	return int(schedule)
 
-def get_is_exporting():
-	grid_battery_status = get_grid_battery_status(1)
+async def get_is_exporting():
+	grid_battery_status = await get_grid_battery_status(1)
 	if get_hot_water_status(0) != 1:
 		is_exporting = grid_battery_status + HOT_WATER_CONSUMPTION < 0
 	else:
@@ -100,40 +100,40 @@ def set_health_status():
 
 async def update_info_and_display():
 	try:
-		automation_feed_value = get_feed_value(HOT_WATER_AUTOMATION_FEED_ID)
+		automation_feed_value = await get_feed_value(HOT_WATER_AUTOMATION_FEED_ID)
 		print(f"Automation swich status: {automation_feed_value}")
 		if automation_feed_value == 0:
-			set_hot_water(True)
+			await set_hot_water(True)
 			return
 
 		if get_schedule_status() != 1:
-			set_hot_water(False)
+			await set_hot_water(False)
 			return
 
-		away_mode_status = get_feed_value(AWAY_MODE_FEED_ID)
+		away_mode_status = await get_feed_value(AWAY_MODE_FEED_ID)
 		print(f"Away mode status: {away_mode_status}")
-		solar_price = get_feed_value(SOLAR_PRICE_FEED_ID)
-		grid_battery_status = get_grid_battery_status(0)
+		solar_price = await get_feed_value(SOLAR_PRICE_FEED_ID)
+		grid_battery_status = await get_grid_battery_status(0)
 		#battery_status = get_battery_status()
 		battery_status = 0
-		forced_status = get_forced_status()
+		forced_status = await get_forced_status()
 		now = datetime.datetime.now().time()
-		is_exporting = get_is_exporting()
+		is_exporting = await get_is_exporting()
 		if (automation_feed_value == 0 or (is_exporting or solar_price < 0 or forced_status == 1)) and not (battery_status or away_mode_status):
-			set_hot_water(True)
+			await set_hot_water(True)
 		else:
-			set_hot_water(False)
+			await set_hot_water(False)
 			
 	except Exception as e:
 		print(f"Error updating info: {e}")
 
 async def main():
 	print("Starting up...")
-	await update_info_and_display()
-	print("Running.")
-	while True:
-		await asyncio.sleep(INTERVAL)
+	async with emoncms:
 		await update_info_and_display()
+		print("Running.")
+		async for tick in Ticker(INTERVAL):
+			await update_info_and_display()
 
 if __name__ == "__main__":
 	asyncio.run(main())
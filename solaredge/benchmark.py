@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import importlib.util
+import multiprocessing
+import aiohttp
+import solaredge_modbus
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from emonlib.emoncms import EmonCMS
+from emonlib.spool import Spool
+from emonlib.sinks import Outputs
+from emonlib.sender import Coalescer
+from emonlib.health import HealthReporter
+from emonlib.aggregate import WindowAggregator
+from emonlib.demand import DemandEstimator
+import simulator
+
+# Cycle throughput benchmark for solaredge-emoncms.py. The simulated inverters
+# and EmonCMS sink run in a separate process, so the CPU time measured here is
+# the collector's own. Every device runs the collector's own device_loop ->
+# poll_device -> publish pipeline with INTERVAL 0, so each one reads again as
+# soon as its last read is published, and a run ends once the most polled
+# device has been read --cycles times. A cycle is one poll of every device.
+#
+#   python3 benchmark.py --cycles 500 --latency 0.01
+#   python3 benchmark.py --drop 0.01 --partial 0.01
+#   python3 benchmark.py --window 10
+#   python3 benchmark.py --adaptive
+
+CYCLES = 200
+WARMUP = 10 #CYCLES NOT MEASURED, PLANS AND STATIC REGISTERS ARE FILLED HERE
+
+COLLECTOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "solaredge-emoncms.py")
+
+def load_collector():
+	spec = importlib.util.spec_from_file_location("collector", COLLECTOR)
+	collector = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(collector)
+	return collector
+
+def percentile(samples, q):
+	ordered = sorted(samples)
+	return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def run_simulator(options, ready):
+	try:
+		asyncio.run(simulator.serve(ready=ready, **options))
+	except KeyboardInterrupt:
+		pass
+
+async def sink_stats(host, port):
+	async with aiohttp.ClientSession() as session:
+		async with session.get(f"http://{host}:{port}/stats") as response:
+			return await response.json()
+
+async def benchmark(collector, args, spool_path):
+	collector.emoncms = EmonCMS(f"http://{args.host}:{args.sink_port}", "benchmark", spool=Spool(spool_path), metrics=collector.metrics)
+	collector.health = HealthReporter("")
+	collector.demand_estimator = DemandEstimator(every=collector.DEMAND_EVERY)
+	if args.window:
+		collector.aggregator = WindowAggregator(args.window, keys=collector.AGGREGATE_KEYS, default=collector.AGGREGATE_DEFAULT)
+	storage = 1 if hasattr(solaredge_modbus, "StorageInverter") else 0
+	collector.devices = collector.build_devices([{
+		"phase": phase,
+		"host": args.host,
+		"port": args.port + index,
+		"unit": 1,
+		"storage": storage,
+		"meters": list(range(1, args.meters + 1)),
+		"batteries": list(range(1, args.batteries + 1)),
+	} for index, phase in enumerate(args.phases)])
+	collector.derived = collector.build_derived(collector.devices)
+	# Every device every poll unless --adaptive, so runs stay comparable, and
+	# no ticker wait
+	collector.pacers = collector.build_pacers(collector.devices) if args.adaptive else {}
+	collector.INTERVAL = 0
+	collector.backoffs = collector.build_backoffs(collector.devices)
+
+	enabled = [device_name for device_name, device_config in collector.devices.items() if device_config["enabled"]]
+	counts = dict.fromkeys(enabled, 0)
+	walls = []
+	run = {"target": args.warmup, "measuring": False}
+	reached = asyncio.Event()
+	poll_device = collector.poll_device
+
+	async def timed_poll(device_name, device_config, post_queue):
+		wall = time.perf_counter()
+		try:
+			return await poll_device(device_name, device_config, post_queue)
+		finally:
+			if run["measuring"]:
+				walls.append(time.perf_counter() - wall)
+			counts[device_name] += 1
+			if counts[device_name] >= run["target"]:
+				reached.set()
+
+	collector.poll_device = timed_poll
+	async with Outputs([collector.emoncms], maxsize=collector.POST_QUEUE_SIZE, workers=collector.POST_WORKERS, policy=collector.POST_OVERLOAD) as outputs:
+		post_queue = Coalescer(outputs, linger=collector.POST_LINGER)
+		tasks = [asyncio.create_task(collector.device_loop(device_name, collector.devices[device_name], post_queue)) for device_name in enabled]
+		try:
+			await reached.wait()
+			reached.clear()
+			counts.update(dict.fromkeys(enabled, 0))
+			collector.read_totals()
+			run.update({"target": args.cycles, "measuring": True})
+			started = time.perf_counter()
+			cpu = time.process_time()
+			await reached.wait()
+			elapsed = time.perf_counter() - started
+			cpu = time.process_time() - cpu
+			reads = collector.read_totals()
+		finally:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+		post_queue.flush()
+		queue = post_queue.metrics()
+	sink = await sink_stats(args.host, args.sink_port)
+
+	polls = sum(counts.values())
+	cycles = polls / len(enabled)
+	print(f"{polls} polls of {len(enabled)} devices on {len(args.phases)} inverters, {args.latency * 1000:.1f} ms Modbus latency, drop {args.drop}, partial {args.partial}")
+	print(f"Throughput      {cycles / elapsed:.1f} cycles/s ({polls / elapsed:.0f} polls/s)")
+	print(f"Poll latency    p50 {percentile(walls, 0.5) * 1000:.1f} ms  p99 {percentile(walls, 0.99) * 1000:.1f} ms  max {max(walls) * 1000:.1f} ms")
+	print(f"CPU per cycle   {cpu / cycles * 1000:.2f} ms (mean)")
+	print(f"Read time       {reads['serial'] * 1000:.0f} ms of reads overlapped into {reads['busy'] * 1000:.0f} ms busy")
+	print("Polls           " + ", ".join(f"{name} {count}" + (f" (now every {collector.pacers[name].interval:g}s)" if name in collector.pacers else "") for name, count in counts.items()))
+	print(f"Posted          {sink['bulk']} bulk requests, {sink['rows']} rows, {sink['values']} values")
+	print(f"Post queue      {queue}")
+	print(f"Demand          {collector.demand_estimator.stats}")
+	for endpoint, stats in collector.connection_stats().items():
+		print(f"Connection      {endpoint} {stats}")
+	for stage, (count, mean, p99) in collector.metrics.summary().items():
+		print(f"Stage {stage:<9} {count} samples, mean {mean * 1000:.2f} ms, p99 <= {p99 * 1000:.0f} ms")
+
+def main():
+	parser = simulator.arguments()
+	parser.description = "Cycle throughput benchmark for solaredge-emoncms.py"
+	parser.add_argument("--cycles", type=int, default=CYCLES)
+	parser.add_argument("--warmup", type=int, default=WARMUP)
+	parser.add_argument("--adaptive", action="store_true", help="pace each device as the collector does, POLL_MAX_INTERVAL")
+	parser.add_argument("--window", type=float, default=0, help="aggregate over this many seconds, as PUBLISH_WINDOW")
+	args = parser.parse_args()
+
+	ready = multiprocessing.Event()
+	server = multiprocessing.Process(target=run_simulator, args=(simulator.simulator_options(args), ready), daemon=True)
+	server.start()
+	try:
+		if not ready.wait(10):
+			print("Simulator did not start")
+			return
+		collector = load_collector()
+		with tempfile.TemporaryDirectory() as directory:
+			asyncio.run(benchmark(collector, args, os.path.join(directory, "spool.db")))
+		collector.read_executor.shutdown(wait=False)
+	finally:
+		server.terminate()
+		server.join()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,231 @@
+import random
+import threading
+import time
+
+import solaredge_modbus
+
+# One long lived Modbus TCP connection per inverter endpoint. The Inverter,
+# StorageInverter, Meter and Battery readers for every unit behind the
+# endpoint are all built on the same client so a cycle costs no TCP setups
+# once the socket is up.
+#
+# Batteries behind each unit are discovered once and the Battery objects
+# kept, until the connection is re-established or rediscover() is called
+# (the collector does on SIGHUP).
+#
+# Requests are only paced when the inverter shows it needs it: a failed or
+# short read opens a gap between requests on that endpoint, which widens
+# with each further strained read and closes again as reads succeed.
+#
+# A call can be given a deadline (time.monotonic()) that the worker thread
+# keeps itself, since the caller giving up on it does not stop a blocking
+# read: waiting for the endpoint's lock, each Modbus request's timeout and
+# the gaps between register blocks are all cut to what is left of it, and
+# DeadlineExceeded is raised once it has passed.
+
+BACKOFF_MIN = 0.5 #SECONDS
+BACKOFF_MAX = 60 #SECONDS
+PROBE_AFTER = 30 #SECONDS IDLE BEFORE THE SOCKET IS PROBED
+PROBE_REGISTER = "c_sunspec_did"
+GAP_MIN = 0.02 #SECONDS BETWEEN REQUESTS ONCE PACING STARTS
+GAP_MAX = 0.5 #SECONDS
+TIMEOUT_MIN = 0.05 #SECONDS, THE SHORTEST REQUEST TIMEOUT A DEADLINE CUTS TO
+
+class DeadlineExceeded(TimeoutError):
+	pass
+
+class ModbusConnection:
+
+	def __init__(self, host, port, unit=1, timeout=5, retries=3):
+		self.host = host
+		self.port = port
+		self.master = solaredge_modbus.Inverter(host=host, port=port, retries=retries, timeout=timeout, unit=unit)
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.deadline = None
+		self.readers = {}
+		self.discovered = {}
+		self.failures = 0
+		self.next_attempt = 0
+		self.last_io = 0
+		self.io_time = 0.0 #SECONDS IN READS WITH THE LOCK HELD, NOT WAITING FOR IT
+		self.gap = 0.0
+		self.stats = {"connects": 0, "reconnects": 0, "reuses": 0, "probes": 0, "probe_failures": 0, "failures": 0, "skipped": 0, "discoveries": 0, "paced": 0, "gap_ms": 0.0, "deadlines": 0}
+
+	def __repr__(self):
+		return f"ModbusConnection({self.host}:{self.port})"
+
+	def reader(self, name, factory):
+		# Child readers share the master's client, so build each one once
+		if name not in self.readers:
+			self.readers[name] = factory(self.master)
+		return self.readers[name]
+
+	def inverter(self, unit):
+		if unit == self.master.unit:
+			return self.master
+		return self.reader(f"inverter{unit}", lambda parent: solaredge_modbus.Inverter(parent=parent, unit=unit))
+
+	def batteries(self, unit):
+		# Only call from inside call(), discovery reads registers
+		found = self.discovered.get(unit)
+		if found is None:
+			found = self.discovered[unit] = self.inverter(unit).batteries()
+			self.stats["discoveries"] += 1
+		return found
+
+	def battery(self, unit, index):
+		# Only call from inside call(). A battery missing from discovery (its
+		# DID read 255 then, e.g. while it woke up) is looked for again next
+		# time rather than being missing until a restart
+		found = self.batteries(unit).get(f"Battery{index}")
+		if found is None:
+			print(f"{self}: Battery{index} not found behind unit {unit}, rediscovering")
+			self.discovered.pop(unit, None)
+		return found
+
+	def rediscover(self):
+		# Battery readers keep values from the batteries found before
+		self.discovered = {}
+		for name, reader in self.readers.items():
+			if name.startswith("battery"):
+				reader.reset()
+
+	def connected(self):
+		return self.master.connected()
+
+	def strain(self):
+		# The inverter dropped or cut short a read, space requests out more
+		self.gap = min(GAP_MAX, max(GAP_MIN, self.gap * 2))
+		self.stats["gap_ms"] = round(self.gap * 1000, 1)
+
+	def relax(self):
+		self.gap = self.gap / 2 if self.gap > GAP_MIN else 0.0
+		self.stats["gap_ms"] = round(self.gap * 1000, 1)
+
+	def _pace(self):
+		if self.gap:
+			wait = self.last_io + self.gap - time.monotonic()
+			if wait > 0:
+				self.stats["paced"] += 1
+				time.sleep(wait)
+
+	def _request_timeout(self, timeout):
+		# solaredge_modbus tries each request up to retries times
+		params = getattr(self.master.client, "comm_params", None)
+		if params is not None:
+			params.timeout_connect = timeout
+
+	def check_deadline(self):
+		# Only call from inside call(), e.g. between register blocks
+		if self.deadline is None:
+			return
+		remaining = self.deadline - time.monotonic()
+		if remaining <= 0:
+			self.stats["deadlines"] += 1
+			raise DeadlineExceeded(f"{self} read past its deadline")
+		self._request_timeout(max(TIMEOUT_MIN, min(self.timeout, remaining / max(1, self.master.retries))))
+
+	def _backoff(self):
+		self.failures += 1
+		self.stats["failures"] += 1
+		delay = min(BACKOFF_MAX, BACKOFF_MIN * (2 ** (self.failures - 1)))
+		self.next_attempt = time.monotonic() + random.uniform(delay / 2, delay)
+
+	def _drop(self):
+		try:
+			self.master.disconnect()
+		except Exception:
+			pass
+		self._backoff()
+
+	def _probe(self):
+		self.stats["probes"] += 1
+		try:
+			if self.master.read(PROBE_REGISTER)[PROBE_REGISTER]:
+				return True
+		except Exception:
+			pass
+		self.stats["probe_failures"] += 1
+		return False
+
+	def _ensure_connected(self):
+		now = time.monotonic()
+		if self.master.connected():
+			if now - self.last_io < PROBE_AFTER or self._probe():
+				self.stats["reuses"] += 1
+				return True
+			self._drop()
+			return False
+		if now < self.next_attempt:
+			self.stats["skipped"] += 1
+			return False
+		if self.master.connect():
+			self.stats["reconnects" if self.stats["connects"] else "connects"] += 1
+			# Batteries may have changed while the link was down
+			self.discovered = {}
+			self.failures = 0
+			self.last_io = now
+			return True
+		self._backoff()
+		return False
+
+	def call(self, func, *args, deadline=None):
+		# Returns None without touching the socket while backing off
+		if deadline is None:
+			self.lock.acquire()
+		elif not self.lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+			self.stats["deadlines"] += 1
+			raise DeadlineExceeded(f"{self} busy until past the deadline")
+		try:
+			self.deadline = deadline
+			self.check_deadline()
+			if not self._ensure_connected():
+				return None
+			self._pace()
+			self.check_deadline()
+			started = time.monotonic()
+			try:
+				result = func(*args)
+			except DeadlineExceeded:
+				# The inverter is slow, not gone, so the socket is kept
+				self.strain()
+				raise
+			except Exception:
+				self.strain()
+				self._drop()
+				raise
+			finally:
+				self.io_time += time.monotonic() - started
+			if self.master.connected():
+				self.last_io = time.monotonic()
+			else:
+				self.strain()
+				self._backoff()
+			return result
+		finally:
+			if self.deadline is not None:
+				self.deadline = None
+				self._request_timeout(self.timeout)
+			self.lock.release()
+
+connections = {}
+
+def get_connection(host, port, unit=1, timeout=5, retries=3):
+	# Units behind the same endpoint share its connection, the first unit
+	# seen is used for probing
+	key = (host, port)
+	if key not in connections:
+		connections[key] = ModbusConnection(host, port, unit=unit, timeout=timeout, retries=retries)
+	return connections[key]
+
+def rediscover():
+	for conn in connections.values():
+		conn.rediscover()
+
+def io_time():
+	# Seconds spent reading on all endpoints, summed over them
+	return sum(conn.io_time for conn in connections.values())
+
+def connection_stats():
+	return {f"{conn.host}:{conn.port}": dict(conn.stats) for conn in connections.values()}
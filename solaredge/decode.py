@@ -0,0 +1,76 @@
+# Decode plans map each value register to its scale factor register and the
+# transform it needs. A plan is compiled once per device type from the first
+# full read and then applied to every later read in a single pass.
+#
+# The keys a plan produces are fixed when it is compiled, so each plan owns a
+# record Schema and every read is decoded straight into a Record's value
+# array rather than a new dict.
+
+from emonlib.record import Schema
+
+PASSTHROUGH = 0
+NEGATE = 1
+CLAMP = 2
+
+NEGATED_KEYS = {
+	"meter": {"l1_power", "l2_power", "l3_power"},
+}
+CLAMPED_SOURCES = {"battery"}
+UNCLAMPED_KEYS = {"instantaneous_power"}
+
+MULTIPLIERS = {scale: 10 ** scale for scale in range(-10, 11)}
+
+def scale_key(k, values):
+	k_split = k.split("_")
+	if f"{k_split[len(k_split) - 1]}_scale" in values:
+		return f"{k_split[len(k_split) - 1]}_scale"
+	if f"{k}_scale" in values:
+		return f"{k}_scale"
+	return None
+
+def transform(source, k):
+	if k in NEGATED_KEYS.get(source, ()):
+		return NEGATE
+	if source in CLAMPED_SOURCES and k not in UNCLAMPED_KEYS:
+		return CLAMP
+	return PASSTHROUGH
+
+class DecodePlan:
+
+	def __init__(self, source, values):
+		self.source = source
+		self.size = len(values)
+		self.steps = [(i, k, scale_key(k, values), transform(source, k)) for i, k in enumerate(k for k, v in values.items() if isinstance(v, (int, float)) and "_scale" not in k)]
+		self.schema = Schema(k for i, k, scale, op in self.steps)
+
+	def apply(self, values):
+		record = self.schema.record()
+		processed = record.values
+		for i, k, scale, op in self.steps:
+			v = values[k]
+			if op == CLAMP and v < 0:
+				processed[i] = 0.0
+			elif op == NEGATE:
+				# Meter phase powers have always been posted unscaled and inverted
+				processed[i] = -v
+			elif scale is None:
+				processed[i] = v
+			else:
+				s = values[scale]
+				processed[i] = v * (MULTIPLIERS[s] if s in MULTIPLIERS else 10 ** s)
+		return record
+
+def decode(plans, source, values, key=None):
+	# Plans are kept per device (key) as inverter models differ in register maps
+	key = key or source
+	plan = plans.get(key)
+	if plan is None or plan.size != len(values):
+		plan = DecodePlan(source, values)
+		# Short "not connected" reads are decoded but never replace a full plan
+		if len(values) > 1:
+			plans[key] = plan
+	try:
+		return plan.apply(values)
+	except KeyError:
+		plans.pop(key, None)
+		return DecodePlan(source, values).apply(values)
@@ -0,0 +1,109 @@
+import time
+
+import solaredge_modbus
+
+# Registers are grouped by how often they change so that each cycle only the
+# fast tier goes over the wire. Static nameplate and identity registers are
+# read once for the life of the process, slow registers (energy counters, SoH,
+# power control settings) every SLOW_REFRESH seconds.
+#
+# Scale factors are not treated as static: SolarEdge inverters move them with
+# the magnitude of the value, so each one is read in the same tier as the
+# values it scales. They sit inside the same register block, so this costs no
+# extra requests.
+
+STATIC = "static"
+SLOW = "slow"
+FAST = "fast"
+
+SLOW_REFRESH = 60 #SECONDS
+TIER_REFRESH = {STATIC: None, SLOW: SLOW_REFRESH, FAST: 0}
+
+STATIC_KEYS = {
+	"rated_energy",
+	"maximum_charge_continuous_power",
+	"maximum_discharge_continuous_power",
+	"maximum_charge_peak_power",
+	"maximum_discharge_peak_power",
+}
+
+SLOW_KEYS = {
+	"soh",
+	"rrcr_state",
+	"active_power_limit",
+	"cosphi",
+	"commit_power_control_settings",
+	"restore_power_control_default_settings",
+	"reactive_power_config",
+	"reactive_power_response_time",
+	"advanced_power_control_enable",
+	"export_control_mode",
+	"export_control_limit_mode",
+	"export_control_site_limit",
+}
+
+def register_tier(key):
+	if key.startswith("c_") or key in STATIC_KEYS:
+		return STATIC
+	if "energy" in key or key in SLOW_KEYS:
+		return SLOW
+	return FAST
+
+def tier_plan(registers, rtype=solaredge_modbus.registerType.HOLDING):
+	# One block read per tier and register batch, the same way read_all()
+	# issues one block read per batch
+	plan = {STATIC: [], SLOW: [], FAST: []}
+	groups = {}
+	for k, v in registers.items():
+		if v[2] != rtype:
+			continue
+		groups.setdefault((register_tier(k), v[7]), {})[k] = v
+	for (tier, batch), group in sorted(groups.items(), key=lambda item: item[0][1]):
+		plan[tier].append(group)
+	return plan
+
+class TieredReader:
+
+	def __init__(self, device=None, refresh=TIER_REFRESH):
+		self.device = device
+		self.refresh = refresh
+		self.plan = None
+		self.cache = {}
+		self.last_read = {}
+
+	def reset(self):
+		self.cache = {}
+		self.last_read = {}
+
+	def due(self, tier, now):
+		last = self.last_read.get(tier)
+		if last is None:
+			return True
+		refresh = self.refresh[tier]
+		return refresh is not None and now - last >= refresh
+
+	def read_all(self, device=None, check=None):
+		# Blocking, like the solaredge_modbus read_all() it stands in for.
+		# check() is called before each block and raises to stop the read
+		device = device or self.device
+		if self.plan is None:
+			self.plan = tier_plan(device.registers)
+		now = time.monotonic()
+		for tier, groups in self.plan.items():
+			if not self.due(tier, now):
+				continue
+			complete = True
+			for group in groups:
+				if check is not None:
+					check()
+				values = device._read_all(group, solaredge_modbus.registerType.HOLDING)
+				if len(values) != len(group):
+					# Drop what this block held so the caller sees a short read
+					complete = False
+					for k in group:
+						self.cache.pop(k, None)
+					continue
+				self.cache.update(values)
+			if complete:
+				self.last_read[tier] = now
+		return dict(self.cache)
@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+
+import sys
+import math
+import time
+import json
+import random
+import struct
+import asyncio
+import argparse
+from array import array
+
+import solaredge_modbus
+from aiohttp import web
+
+# Simulated SolarEdge inverters and a stub EmonCMS, so the collector can be
+# run and benchmarked without real hardware.
+#
+# Each inverter is a raw Modbus TCP server (function codes 3 and 4) whose
+# register image is built from the solaredge_modbus register maps: the
+# inverter, StorageInverter (when the installed solaredge_modbus has it),
+# each meter and each battery. Power, current and energy registers move over
+# time so the change-only publishing and decode paths see realistic data.
+# Latency, dropped connections and short (partial) reads can be injected per
+# request.
+#
+# Run on its own it serves the three phases from inverters.example.json on
+# consecutive local ports, plus the EmonCMS sink:
+#
+#   python3 simulator.py --port 15020 --latency 0.01 --drop 0.001
+#
+# and an inverters.json pointing RED/WHITE/BLUE at 127.0.0.1:15020-15022.
+
+HOST = "127.0.0.1"
+PORT = 15020 #FIRST INVERTER, ONE PORT PER PHASE
+PHASES = ["RED", "WHITE", "BLUE"]
+SINK_PORT = 18080 #STUB EMONCMS
+LATENCY = 0.005 #SECONDS PER MODBUS REQUEST
+JITTER = 0.002 #SECONDS, UNIFORM
+DROP = 0.0 #CHANCE A REQUEST CLOSES THE CONNECTION INSTEAD OF ANSWERING
+PARTIAL = 0.0 #CHANCE A RESPONSE CARRIES FEWER REGISTERS THAN ASKED
+UPDATE_EVERY = 0.5 #SECONDS BETWEEN LIVE VALUE UPDATES
+
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_ADDRESS = 0x02
+
+DIDS = {"Inverter": 103, "Meter": 203, "Battery": 802}
+STRINGS = {"c_manufacturer": "SolarEdge", "c_model": "SE10K-SIM", "c_version": "0004.0020.0036", "c_serialnumber": "SIM"}
+BATTERY_SLOTS = 2 #BATTERY_REGISTER_OFFSETS IN solaredge_modbus
+MISSING_BATTERY = 255
+
+# Base values for the registers that matter to the collector, anything not
+# listed gets a small stable value of the right type
+BASES = {
+	"power_ac": 4000, "power_dc": 4200, "power_apparent": 4100, "power_reactive": 200, "power_factor": 98,
+	"current": 1800, "l1_current": 600, "l2_current": 600, "l3_current": 600, "current_dc": 1100,
+	"l1_voltage": 24000, "l2_voltage": 24000, "l3_voltage": 24000, "voltage_dc": 38000,
+	"frequency": 5000, "temperature": 4500, "status": 4,
+	"power": 1500, "l1_power": 500, "l2_power": 500, "l3_power": 500,
+	"instantaneous_power": -1500.0, "instantaneous_voltage": 400.0, "instantaneous_current": -3.7,
+	"available_energy": 9700.0, "maximum_energy": 9700.0, "rated_energy": 9700.0, "soe": 62.0, "soh": 100.0,
+	"average_temperature": 28.0, "maximum_temperature": 31.0,
+}
+SCALES = {"current_scale": -2, "l1_voltage_scale": -2, "voltage_scale": -2, "frequency_scale": -2, "temperature_scale": -2, "power_factor_scale": -2, "voltage_dc_scale": -2, "current_dc_scale": -2}
+INT_RANGES = {"UINT16": (0, 0xfffe), "INT16": (-0x7fff, 0x7fff), "UINT32": (0, 0xfffffffe), "ACC32": (1, 0xffffffff), "INT32": (-0x7fffffff, 0x7fffffff), "UINT64": (0, 0xfffffffffffffffe)}
+
+def device_models(meters=1, batteries=2):
+	inverter = solaredge_modbus.Inverter(host=HOST, port=0)
+	models = [inverter]
+	storage = getattr(solaredge_modbus, "StorageInverter", None)
+	if storage is not None:
+		models.append(storage(parent=inverter))
+	models += [solaredge_modbus.Meter(parent=inverter, offset=index) for index in range(meters)]
+	models += [solaredge_modbus.Battery(parent=inverter, offset=index) for index in range(batteries)]
+	return inverter, models
+
+def live(key, dtype, value):
+	# Registers that are changed by update(), scale factors and battery
+	# capacities stay fixed
+	if key.startswith("c_") or key.endswith("_scale") or dtype.name == "STRING":
+		return False
+	if "energy" in key and isinstance(value, float):
+		return False
+	return any(part in key for part in ("power", "current", "energy", "voltage", "soe", "frequency", "temperature"))
+
+class RegisterImage:
+
+	def __init__(self, meters=1, batteries=2, seed=1):
+		self.words = array("H", bytes(2 * 0x10000))
+		self.random = random.Random(seed)
+		self.phase = self.random.uniform(0, 2 * math.pi)
+		self.started = time.monotonic()
+		self.live = []
+		inverter, models = device_models(meters, batteries)
+		for model in models:
+			for key, (address, length, rtype, dtype, vtype, label, fmt, batch) in model.registers.items():
+				value = self.initial(model, key, dtype, length)
+				self.store(model, address, length, dtype, value)
+				if live(key, dtype, value):
+					self.live.append((model, key, address, length, dtype, value))
+		for index in range(batteries, BATTERY_SLOTS):
+			self.store(inverter, inverter.battery_dids[index][0], 1, solaredge_modbus.registerDataType.UINT16, MISSING_BATTERY)
+
+	def initial(self, model, key, dtype, length):
+		kind = model.model.rstrip("0123456789")
+		if dtype.name == "STRING":
+			return STRINGS.get(key, "")[:length * 2]
+		if key == "c_sunspec_did":
+			return DIDS.get(kind, 1)
+		if key == "c_deviceaddress":
+			return 1
+		if key.endswith("_scale"):
+			return SCALES.get(key, 0)
+		if key in BASES:
+			return BASES[key]
+		if "energy" in key:
+			return self.random.randint(1000000, 20000000)
+		if dtype.name in ("FLOAT32", "SEFLOAT"):
+			return round(self.random.uniform(0, 100), 2)
+		low, high = INT_RANGES.get(dtype.name, (0, 0xfffe))
+		return self.random.randint(max(low, 0), min(high, 1000))
+
+	def store(self, model, address, length, dtype, value):
+		if dtype.name == "ACC32":
+			dtype = solaredge_modbus.registerDataType.UINT32
+		if dtype.name in INT_RANGES:
+			low, high = INT_RANGES[dtype.name]
+			value = min(max(int(value), low), high)
+		if dtype.name == "STRING":
+			value = value.ljust(length * 2, "\x00")
+		words = model._encode_value(value, dtype)[:length]
+		self.words[address:address + len(words)] = array("H", words)
+
+	def update(self):
+		# Slow sine over the base value plus noise, energy counters only climb
+		elapsed = time.monotonic() - self.started
+		wave = math.sin(elapsed / 60 + self.phase)
+		for model, key, address, length, dtype, base in self.live:
+			if "energy" in key:
+				value = base + int(elapsed * 2)
+			elif key == "soe":
+				value = min(100.0, max(0.0, base + 10 * wave))
+			else:
+				value = base * (1 + 0.2 * wave + self.random.uniform(-0.02, 0.02))
+			self.store(model, address, length, dtype, value)
+
+	def read(self, address, count):
+		if address + count > len(self.words):
+			return None
+		return self.words[address:address + count]
+
+class ModbusSimulator:
+
+	def __init__(self, host=HOST, port=PORT, units=None, latency=LATENCY, jitter=JITTER, drop=DROP, partial=PARTIAL, update_every=UPDATE_EVERY):
+		self.host = host
+		self.port = port
+		self.units = units if units is not None else {1: RegisterImage()}
+		self.latency = latency
+		self.jitter = jitter
+		self.drop = drop
+		self.partial = partial
+		self.update_every = update_every
+		self.random = random.Random()
+		self.server = None
+		self.updater = None
+		self.clients = set()
+		self.stats = {"connections": 0, "requests": 0, "registers": 0, "drops": 0, "partials": 0, "exceptions": 0}
+
+	async def __aenter__(self):
+		await self.start()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def start(self):
+		self.server = await asyncio.start_server(self.handle, self.host, self.port)
+		self.updater = asyncio.create_task(self.run())
+
+	async def close(self):
+		if self.updater is not None:
+			self.updater.cancel()
+			await asyncio.gather(self.updater, return_exceptions=True)
+			self.updater = None
+		if self.server is not None:
+			self.server.close()
+			for client in list(self.clients):
+				client.cancel()
+			await asyncio.gather(*self.clients, return_exceptions=True)
+			await self.server.wait_closed()
+			self.server = None
+
+	async def run(self):
+		while True:
+			for image in self.units.values():
+				image.update()
+			await asyncio.sleep(self.update_every)
+
+	def exception(self, transaction, unit, function, code):
+		self.stats["exceptions"] += 1
+		return struct.pack(">HHHBBB", transaction, 0, 3, unit, function | 0x80, code)
+
+	def respond(self, transaction, unit, pdu):
+		function = pdu[0]
+		image = self.units.get(unit)
+		if function not in (3, 4) or len(pdu) < 5:
+			return self.exception(transaction, unit, function, ILLEGAL_FUNCTION)
+		address, count = struct.unpack(">HH", pdu[1:5])
+		words = image.read(address, count) if image is not None else None
+		if words is None or not 1 <= count <= 125:
+			return self.exception(transaction, unit, function, ILLEGAL_ADDRESS)
+		if self.partial and self.random.random() < self.partial and count > 1:
+			self.stats["partials"] += 1
+			words = words[:self.random.randint(1, count - 1)]
+		self.stats["registers"] += len(words)
+		# Modbus registers go out big endian
+		words = array("H", words)
+		if sys.byteorder == "little":
+			words.byteswap()
+		data = words.tobytes()
+		return struct.pack(">HHHBBB", transaction, 0, 3 + len(data), unit, function, len(data)) + data
+
+	async def handle(self, reader, writer):
+		self.stats["connections"] += 1
+		client = asyncio.current_task()
+		self.clients.add(client)
+		try:
+			while True:
+				header = await reader.readexactly(7)
+				transaction, protocol, length, unit = struct.unpack(">HHHB", header)
+				pdu = await reader.readexactly(length - 1)
+				self.stats["requests"] += 1
+				if self.drop and self.random.random() < self.drop:
+					self.stats["drops"] += 1
+					break
+				delay = self.latency + self.random.uniform(0, self.jitter)
+				if delay > 0:
+					await asyncio.sleep(delay)
+				writer.write(self.respond(transaction, unit, pdu))
+				await writer.drain()
+		except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+			# Cancelled by close(), the connection just ends
+			pass
+		finally:
+			self.clients.discard(client)
+			writer.close()
+
+class EmonCMSSink:
+
+	# Accepts what the collectors send and counts it, optionally slow or failing
+
+	def __init__(self, host=HOST, port=SINK_PORT, latency=0.0, fail=0.0):
+		self.host = host
+		self.port = port
+		self.latency = latency
+		self.fail = fail
+		self.random = random.Random()
+		self.runner = None
+		self.stats = {"requests": 0, "bulk": 0, "posts": 0, "rows": 0, "values": 0, "failed": 0}
+
+	async def __aenter__(self):
+		await self.start()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def start(self):
+		app = web.Application()
+		app.router.add_post("/input/bulk.json", self.bulk)
+		app.router.add_post("/input/post.json", self.post)
+		app.router.add_post("/feed/value.json", self.feed)
+		app.router.add_get("/stats", self.report)
+		app.router.add_route("*", "/{tail:.*}", self.other)
+		self.runner = web.AppRunner(app, access_log=None)
+		await self.runner.setup()
+		await web.TCPSite(self.runner, self.host, self.port).start()
+
+	async def close(self):
+		if self.runner is not None:
+			await self.runner.cleanup()
+			self.runner = None
+
+	async def accept(self):
+		self.stats["requests"] += 1
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		if self.fail and self.random.random() < self.fail:
+			self.stats["failed"] += 1
+			return False
+		return True
+
+	async def bulk(self, request):
+		if not await self.accept():
+			return web.Response(status=503)
+		form = await request.post()
+		rows = json.loads(form["data"])
+		self.stats["bulk"] += 1
+		self.stats["rows"] += len(rows)
+		self.stats["values"] += sum(len(row) - 2 for row in rows)
+		return web.Response(text="ok")
+
+	async def post(self, request):
+		if not await self.accept():
+			return web.Response(status=503)
+		form = await request.post()
+		self.stats["posts"] += 1
+		self.stats["rows"] += 1
+		self.stats["values"] += len(json.loads(form.get("fulljson", "{}")))
+		return web.Response(text='{"success": true}')
+
+	async def feed(self, request):
+		if not await self.accept():
+			return web.Response(status=503)
+		return web.Response(text="0")
+
+	async def other(self, request):
+		if not await self.accept():
+			return web.Response(status=503)
+		return web.Response(text="ok")
+
+	async def report(self, request):
+		return web.json_response(self.stats)
+
+async def serve(host=HOST, port=PORT, phases=None, sink_port=SINK_PORT, meters=1, batteries=2, latency=LATENCY, jitter=JITTER, drop=DROP, partial=PARTIAL, sink_latency=0.0, sink_fail=0.0, ready=None):
+	phases = phases or PHASES
+	simulators = [ModbusSimulator(host, port + index, {1: RegisterImage(meters, batteries, seed=index + 1)}, latency, jitter, drop, partial) for index in range(len(phases))]
+	sink = EmonCMSSink(host, sink_port, sink_latency, sink_fail)
+	for simulator in simulators:
+		await simulator.start()
+	await sink.start()
+	if ready is not None:
+		ready.set()
+	try:
+		await asyncio.Event().wait()
+	finally:
+		for simulator in simulators:
+			await simulator.close()
+		await sink.close()
+
+def arguments(parser=None):
+	parser = parser or argparse.ArgumentParser(description="Simulated SolarEdge inverters and EmonCMS")
+	parser.add_argument("--host", default=HOST)
+	parser.add_argument("--port", type=int, default=PORT)
+	parser.add_argument("--phases", nargs="+", default=PHASES)
+	parser.add_argument("--sink-port", type=int, default=SINK_PORT)
+	parser.add_argument("--meters", type=int, default=1)
+	parser.add_argument("--batteries", type=int, default=2)
+	parser.add_argument("--latency", type=float, default=LATENCY)
+	parser.add_argument("--jitter", type=float, default=JITTER)
+	parser.add_argument("--drop", type=float, default=DROP)
+	parser.add_argument("--partial", type=float, default=PARTIAL)
+	parser.add_argument("--sink-latency", type=float, default=0.0)
+	parser.add_argument("--sink-fail", type=float, default=0.0)
+	return parser
+
+def simulator_options(args):
+	return {"host": args.host, "port": args.port, "phases": args.phases, "sink_port": args.sink_port, "meters": args.meters, "batteries": args.batteries, "latency": args.latency, "jitter": args.jitter, "drop": args.drop, "partial": args.partial, "sink_latency": args.sink_latency, "sink_fail": args.sink_fail}
+
+if __name__ == "__main__":
+	args = arguments().parse_args()
+	print(f"Serving {', '.join(args.phases)} on {args.host}:{args.port}-{args.port + len(args.phases) - 1}, EmonCMS on {args.host}:{args.sink_port}")
+	try:
+		asyncio.run(serve(**simulator_options(args)))
+	except KeyboardInterrupt:
+		pass
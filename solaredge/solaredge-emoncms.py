@@ -1,19 +1,70 @@
 #!/usr/bin/python3
 
+import os
+import sys
 import json
+import signal
 import asyncio
+import time
+import functools
 import solaredge_modbus
-import aiohttp
-from datetime import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from emonlib.emoncms import EmonCMS
+from emonlib.spool import Spool
+from emonlib.sender import DROP_OLDEST, MERGE, Coalescer
+from emonlib.sinks import Outputs, InfluxSink, MQTTSink, TOPICS, FIELDS
+from emonlib.deadband import PublishFilter
+from emonlib.scheduler import Ticker, AdaptiveInterval, Backoff
+from emonlib.health import HealthReporter
+from emonlib.metrics import Metrics
+from emonlib.clock import wall_time
+from emonlib.aggregate import WindowAggregator, MEAN, MIN, MAX, LAST
+from emonlib.derived import DerivedMetrics
+from emonlib.demand import DemandEstimator
+from connection import get_connection, connection_stats, io_time, rediscover
+from registers import TieredReader
+from decode import decode
+from concurrent.futures import ThreadPoolExecutor
 
 ##################################################################################
 HEALTHCHECKS_IO_URL = ""
+HEALTH_WINDOW = 60 #SECONDS, AT MOST ONE PING AND ONE LOG PER WINDOW
 
-INTERVAL = 0 #SECONDS
-READTIMEOUT = 5 #SECONDS
+INTERVAL = 1 #SECONDS, CYCLES START ON WHOLE MULTIPLES OF THIS, 0 READS AS FAST AS THE INVERTERS ANSWER
+READ_WORKERS = 8 #BLOCKING MODBUS READS ALLOWED IN FLIGHT AT ONCE
+STATS_EVERY = 60 #TICKS BETWEEN STATS REPORTS
+
+# Each device is polled every INTERVAL while its power is moving and backs
+# off towards POLL_MAX_INTERVAL while it is flat, or straight there while the
+# inverter is off or sleeping at night
+POLL_MAX_INTERVAL = 30 #SECONDS, INTERVAL OR LESS POLLS EVERY DEVICE EVERY CYCLE
+POLL_FAST = 100 #W PER SECOND OF CHANGE THAT DROPS A DEVICE BACK TO INTERVAL
+POLL_FLAT = 10 #W OF CHANGE BETWEEN READS THAT COUNTS AS FLAT
+POLL_KEYS = {"leader": ("power_ac",), "meter": ("power", "l1_power", "l2_power", "l3_power"), "battery": ("instantaneous_power",)}
+IDLE_STATUS = (1, 2) #INVERTER STATUS OFF AND SLEEPING (NIGHT MODE)
+
+LEADER_DEADLINE = 3 #SECONDS
+STORAGE_DEADLINE = 2 #SECONDS
+METER_DEADLINE = 2 #SECONDS
+BATTERY_DEADLINE = 3 #SECONDS
+DEADLINE_GRACE = 1 #SECONDS PAST A DEADLINE BEFORE A READ THAT HAS NOT STOPPED ITSELF IS ABANDONED
+
+# Every device runs its own read -> publish pipeline, so a failing one is
+# backed off on its own while the others keep publishing
+DEVICE_RETRIES = 1 #EXTRA READS BEFORE A POLL COUNTS AS FAILED
+FAIL_BACKOFF = 2 #SECONDS BEFORE A FAILED DEVICE IS READ AGAIN, DOUBLING PER FAILURE
+FAIL_BACKOFF_MAX = 60 #SECONDS
+HELD_MAX_AGE = 60 #SECONDS A DEVICE'S LAST READING STILL COUNTS TOWARDS SITE TOTALS, KEEP ABOVE POLL_MAX_INTERVAL
+
+# inverters.json next to this script lists every inverter to poll, see
+# inverters.example.json. Without it the single inverter below is polled.
+# "enabled": 0 on an inverter stops every device behind it being polled,
+# "leader": 0 only the inverter itself (its meters and batteries still are).
+INVERTERS_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inverters.json")
 
 LEADER_HOST = "localhost"
 LEADER_PORT = 9000
+LEADER_UNIT = 1
 
 PHASE_COLOUR = "RED"
 LEADER_ENABLED = 1
@@ -23,266 +74,503 @@ BATTERY1_ENABLED = 1
 BATTERY2_ENABLED = 1
 
 EMONCMS_API_KEY = ""
-EMONCMS_HEADERS = {"Authorization": f"Bearer {EMONCMS_API_KEY}"}
 EMONCMS_SERVER_IP = ""
 
+POST_QUEUE_SIZE = 30 #CYCLES WAITING TO BE SENT
+POST_WORKERS = 2
+POST_OVERLOAD = DROP_OLDEST #DROP_OLDEST OR MERGE
+POST_LINGER = 0.05 #SECONDS A READING WAITS FOR OTHER DEVICES TO SHARE ITS POST
+
+# Extra outputs alongside EmonCMS, each with its own queue
+INFLUXDB_URL = None #E.G. "http://localhost:8086" TO WRITE STRAIGHT INTO INFLUXDB
+INFLUXDB_DATABASE = "telegraf"
+INFLUXDB_MEASUREMENT = "mqtt_consumer" #AND topic=<NODE>/<KEY> value=..., AS TELEGRAF WRITES THE EMONCMS MQTT FEEDS
+INFLUXDB_TOPIC_PREFIX = "" #IN FRONT OF <NODE>/<KEY>, E.G. "emon/" IF TELEGRAF'S TOPICS CARRY THE EMONCMS MQTT BASE TOPIC
+INFLUXDB_LAYOUT = TOPICS #TOPICS, OR FIELDS FOR ONE LINE PER NODE TAGGED node=<NODE> WITH A FIELD PER KEY
+INFLUXDB_USERNAME = None
+INFLUXDB_PASSWORD = None
+INFLUXDB_BATCH = 5000 #LINES PER WRITE
+INFLUXDB_FLUSH = 5 #SECONDS BETWEEN WRITES
+MQTT_HOST = None #E.G. "localhost" TO PUBLISH emon/<node> JSON, NEEDS paho-mqtt
+MQTT_PORT = 1883
+MQTT_TOPIC = "emon"
+DEADBAND_ABSOLUTE = 0 #SEND ANY CHANGE BY DEFAULT
+DEADBAND_RELATIVE = 0
+DEADBAND_KEYS = {} #PER KEY (ABSOLUTE, RELATIVE) OVERRIDES E.G. {"power_ac": (5, 0)}
+HEARTBEAT = 60 #SECONDS BEFORE AN UNCHANGED VALUE IS SENT AGAIN
+SITE_NODE = "SITE" #WHOLE SITE TOTALS ACROSS ALL PHASES
+PUBLISH_WINDOW = 0 #SECONDS, 0 POSTS EVERY CYCLE, E.G. 10 POSTS ONE AGGREGATED RECORD PER NODE EVERY 10 SECONDS
+AGGREGATE_DEFAULT = MEAN #MEAN, MIN, MAX OR LAST, ENERGY COUNTERS AND STATUS ARE ALWAYS LAST
+DEMAND_NODE = "DEMAND" #LIVE PROJECTION OF THIS 30 MINUTE WINDOW'S DEMAND AND ITS MARGIN TO THE MONTH'S PEAK, None DISABLES
+DEMAND_EVERY = 5 #SECONDS BETWEEN PROJECTIONS
+DEMAND_STATE_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".checkpoint.json" #MONTH'S PEAK SO FAR
+DEMAND_SEED_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "amber-emoncms", "amber-demand-charge.checkpoint.json") #MONTH'S PEAK FROM THE METER HISTORY, None ONLY TRUSTS WINDOWS SEEN HERE
+DEMAND_SEED_EVERY = 300 #SECONDS BETWEEN RE-READS OF DEMAND_SEED_PATH
+AGGREGATE_KEYS = {} #PER KEY STATISTICS E.G. {"power_ac": (MEAN, MIN, MAX)} POSTS power_ac, power_ac_min, power_ac_max
+
+SPOOL_PATH = os.path.splitext(os.path.abspath(__file__))[0] + ".spool.db"
+
+METRICS_PORT = 9101 #PROMETHEUS TEXT ON http://127.0.0.1:9101/, None DISABLES
+METRICS_FILE = None #OR A PATH THE SAME TEXT IS WRITTEN TO EVERY 15 SECONDS
+
 ##################################################################################
 
-async def health_check(session, health, status):
-	try:
-		url = (health)
-		payload = {
-			"status": status,
-			}
-		async with session.post(url, json=payload, timeout=1) as response:
-			response.raise_for_status()
-			if response.status != 200:
-				print("Error sending health check ping to healthchecks.io")
-	except aiohttp.ClientError as e:
-		print(f"Health check error occurred: {e}")
-
-async def post_to_emoncms(session, node_name, data):
-	url = f"http://{EMONCMS_SERVER_IP}/input/post.json?node={node_name}&fulljson={data}"
-	#time = datetime.now()
-	#print(f"POSTING: {node_name}: {time}")
-	async with session.post(url, headers=EMONCMS_HEADERS) as response:
-		response.raise_for_status()
-		if response.status != 200:
-			print(f"Error posting data to EmonCMS: {response.content}")
-			await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Error posting data to EmonCMS: {response.content}")
-
-async def get_device_data(session, data, type):
-	master = solaredge_modbus.Inverter(host=LEADER_HOST, port=LEADER_PORT, retries=3, timeout=5, unit=1)
+# solaredge_modbus is blocking, so reads are handed to a bounded pool and the
+# event loop stays free to overlap devices and post results
+read_executor = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="modbus")
+
+metrics = Metrics("solaredge", port=METRICS_PORT, path=METRICS_FILE)
+
+emoncms = EmonCMS(f"http://{EMONCMS_SERVER_IP}", EMONCMS_API_KEY, spool=Spool(SPOOL_PATH), metrics=metrics)
+
+sinks = [emoncms]
+if INFLUXDB_URL:
+	sinks.append(InfluxSink(INFLUXDB_URL, INFLUXDB_DATABASE, measurement=INFLUXDB_MEASUREMENT, layout=INFLUXDB_LAYOUT, topic_prefix=INFLUXDB_TOPIC_PREFIX, batch_size=INFLUXDB_BATCH, flush_interval=INFLUXDB_FLUSH, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD))
+if MQTT_HOST:
+	sinks.append(MQTTSink(MQTT_HOST, MQTT_PORT, topic=MQTT_TOPIC))
+
+publish_filter = PublishFilter(absolute=DEADBAND_ABSOLUTE, relative=DEADBAND_RELATIVE, heartbeat=HEARTBEAT, keys=DEADBAND_KEYS)
+
+health = HealthReporter(HEALTHCHECKS_IO_URL, window=HEALTH_WINDOW, metrics=metrics)
+
+aggregator = WindowAggregator(PUBLISH_WINDOW, keys=AGGREGATE_KEYS, default=AGGREGATE_DEFAULT) if PUBLISH_WINDOW else None
+
+# Fed with the site's import power, see build_derived
+demand_estimator = DemandEstimator(every=DEMAND_EVERY, path=DEMAND_STATE_PATH) if DEMAND_NODE else None
+
+decode_plans = {}
+
+# Time spent reading, summed over the endpoints' reads ("serial", what polling
+# one device after another would take, from connection.io_time() since "io")
+# and while any read was waiting or in flight ("busy"), the difference being
+# what overlapping the devices saves
+read_stats = {"reads": 0, "busy": 0.0, "inflight": 0, "since": 0.0, "io": 0.0}
+
+# Each device loop's ticker, for the stats report
+tickers = {}
+
+async def run_blocking(func, *args, **kwargs):
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(read_executor, functools.partial(func, *args, **kwargs))
+
+def post_error(name, e, rows):
+	print(f"Error posting data to {name}: {e}")
+	health.error(f"Error posting data to {name}: {e}")
+
+# Reading used when the inverter is not connected, and the least number of
+# registers a complete read returns, per device type
+DEVICE_TYPES = {
+	"leader": ({'power_ac': 0}, 52),
+	"storage": ({'storage_ac_charge_limit': 0}, 12),
+	"meter": ({'l1_power': 0}, 79),
+	"battery": ({'instantaneous_power': 0}, 23),
+}
+
+def device_reader(conn, device_config, type):
+	# The read stops itself between register blocks once its deadline passes
+	unit = device_config["inverter"]["unit"]
+	inverter = conn.inverter(unit)
 	if type == "leader":
-		#t1 = datetime.now()
-		data = master.read_all()
-		#t2 = datetime.now() - t1
-		#print(f"{type} {t2}")
-		if not master.connected():
-			data = {'power_ac': 0}
-			print(f"{type}: not connected")
-			return data
-		if len(data) < 52 and len(data) != 1:
-			print(f"Incomplete data for LEADER")
-			await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Incomplete data for {type}")
-			raise ValueError
-		return data
+		leader = conn.reader(f"leader{unit}", lambda parent: TieredReader(inverter))
+		return lambda: leader.read_all(check=conn.check_deadline)
 	if type == "storage":
-		data = solaredge_modbus.StorageInverter(parent=master).read_all()
-		if not master.connected():
-			data = {'storage_ac_charge_limit': 0}
-			print(f"{type}: not connected")
-			return data
-		if len(data) < 12 and len(data) != 1:
-			print(f"Incomplete data for STORAGE")
-			await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Incomplete data for {type}")
-			raise ValueError
-		return data
+		storage = conn.reader(f"storage{unit}", lambda parent: TieredReader(solaredge_modbus.StorageInverter(parent=inverter)))
+		return lambda: storage.read_all(check=conn.check_deadline)
 	if type == "meter":
-		data = solaredge_modbus.Meter(parent=master, offset=0).read_all()
-		if not master.connected():
-			data = {'l1_power': 0}
-			print(f"{type}: not connected")
-			return data
-		if len(data) < 79 and len(data) != 1:
-			print(f"Incomplete data for METER")
-			await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Incomplete data for {type}")
-			raise ValueError
-		return data
-	if type == "battery1":
-		await asyncio.sleep(0.1)
-		data = master.batteries()["Battery1"].read_all()
-		if not master.connected():
-			data = {'instantaneous_power': 0}
-			print(f"{type}: not connected")
-			return data
-		if len(data) < 23 and len(data) != 1:
-			print(f"Incomplete data for BATTERY1")
-			await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Incomplete data for {type}")
-			raise ValueError
-		return data
-	if type == "battery2":
-		await asyncio.sleep(0.1)
-		data = master.batteries()["Battery2"].read_all()
-		if not master.connected():
-			data = {'instantaneous_power': 0}
-			print(f"{type}: not connected")
-			return data
-		if len(data) < 23 and len(data) != 1:
-			print(f"Incomplete data for BATTERY2")
-			await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Incomplete data for {type}")
-			raise ValueError
-		return data
-	else:
-		#return data.read_all()
+		index = device_config["index"]
+		meter = conn.reader(f"meter{unit}-{index}", lambda parent: TieredReader(solaredge_modbus.Meter(parent=inverter, offset=index - 1)))
+		return lambda: meter.read_all(check=conn.check_deadline)
+	if type == "battery":
+		index = device_config["index"]
+		battery = conn.reader(f"battery{unit}-{index}", lambda parent: TieredReader())
+		def read_battery():
+			# Nothing read from a battery not found counts as incomplete
+			device = conn.battery(unit, index)
+			if device is None:
+				return {}
+			return battery.read_all(device, check=conn.check_deadline)
+		return read_battery
+	raise ValueError
+
+async def get_device_data(device_config, type, deadline):
+	inverter = device_config["inverter"]
+	conn = get_connection(inverter["host"], inverter["port"], unit=inverter["unit"], timeout=5, retries=3)
+	label = f"{inverter['phase']} {type}"
+	not_connected, complete = DEVICE_TYPES[type]
+	# Stamped at the middle of the read, the closest we get to when the
+	# inverter sampled the registers
+	start = wall_time()
+	data = await run_blocking(conn.call, device_reader(conn, device_config, type), deadline=deadline)
+	stamp = (start + wall_time()) / 2
+	if data is None:
+		# Skipped while the connection backs off, there is no reading at all
+		raise ConnectionError(f"{label}: not connected")
+	if not conn.connected():
+		print(f"{label}: not connected")
+		return stamp, dict(not_connected)
+	if len(data) < complete and len(data) != 1:
+		conn.strain()
+		print(f"Incomplete data for {label}")
+		health.error(f"Incomplete data for {label}")
 		raise ValueError
+	conn.relax()
+	return stamp, data
 
-# Device configurations
-devices = {
-	"LEADER": {
-		"enabled": LEADER_ENABLED,
+def load_inverters():
+	if os.path.exists(INVERTERS_CONFIG):
+		with open(INVERTERS_CONFIG) as f:
+			return json.load(f)["inverters"]
+	return [{
+		"phase": PHASE_COLOUR,
+		"host": LEADER_HOST,
+		"port": LEADER_PORT,
+		"unit": LEADER_UNIT,
+		"enabled": 1,
+		"leader": LEADER_ENABLED,
 		"storage": LEADER_STORAGE_ENABLED,
-		"read_storage": 1,
-		"node_name": f"{PHASE_COLOUR}-INVERTER",
-		"data_source": "leader",
-		"storage_source": "storage"
-	},
-	"METER": {
-		"enabled": METER_ENABLED,
-		"read_storage": 0,
-		"node_name": f"{PHASE_COLOUR}-METER",
-		"data_source": "meter"
-	},
-	"BATTERY1": {
-		"enabled": BATTERY1_ENABLED,
-		"read_storage": 0,
-		"node_name": f"{PHASE_COLOUR}-BATTERY1",
-		"data_source": "battery1"
-	},
-	"BATTERY2": {
-		"enabled": BATTERY2_ENABLED,
-		"read_storage": 0,
-		"node_name": f"{PHASE_COLOUR}-BATTERY2",
-		"data_source": "battery2"
-	}
-}
+		"meters": [1] if METER_ENABLED else [],
+		"batteries": [index for index, enabled in ((1, BATTERY1_ENABLED), (2, BATTERY2_ENABLED)) if enabled],
+	}]
+
+def build_devices(inverters):
+	# Device configurations, one set per inverter and posted under its phase
+	devices = {}
+	for inverter in inverters:
+		inverter.setdefault("unit", 1)
+		phase = inverter["phase"]
+		enabled = inverter.get("enabled", 1)
+		devices[f"{phase}-LEADER"] = {
+			"enabled": enabled and inverter.get("leader", 1),
+			"storage": inverter.get("storage", 0),
+			"read_storage": 1,
+			"node_name": f"{phase}-INVERTER",
+			"data_source": "leader",
+			"storage_source": "storage",
+			"deadline": LEADER_DEADLINE,
+			"storage_deadline": STORAGE_DEADLINE,
+			"inverter": inverter
+		}
+		for index in inverter.get("meters", []):
+			devices[f"{phase}-METER{index}"] = {
+				"enabled": enabled,
+				"read_storage": 0,
+				"node_name": f"{phase}-METER" if index == 1 else f"{phase}-METER{index}",
+				"data_source": "meter",
+				"index": index,
+				"deadline": METER_DEADLINE,
+				"inverter": inverter
+			}
+		for index in inverter.get("batteries", []):
+			devices[f"{phase}-BATTERY{index}"] = {
+				"enabled": enabled,
+				"read_storage": 0,
+				"node_name": f"{phase}-BATTERY{index}",
+				"data_source": "battery",
+				"index": index,
+				"deadline": BATTERY_DEADLINE,
+				"inverter": inverter
+			}
+	return devices
+
+devices = build_devices(load_inverters())
+
+def total(*values):
+	return float(sum(values))
 
-async def process_device_data(device_name, device_config, session):
+def imported(*powers):
+	net = total(*powers)
+	return net if net > 0 else 0
+
+def exported(*powers):
+	net = total(*powers)
+	return net if net < 0 else 0
+
+def grid_power(power):
+	# Meter total power scaled by power_scale, positive while importing. The
+	# l1..l3 phase powers are posted unscaled for the existing feeds, so they
+	# only match it while power_scale is 0
+	return -power
+
+def consumption(power_ac, *powers):
+	# What the inverter puts out plus what comes in from (or goes out to) the grid
+	return power_ac + total(*powers)
+
+def soe_energy(soe, available_energy):
+	return (soe / 100) * available_energy
+
+def remaining_hours(soe_kwh, available_energy, instantaneous_power):
+	if instantaneous_power < 0: #discharging when below 0, hours until empty
+		return soe_kwh / instantaneous_power
+	if instantaneous_power > 0: #charging when above 0, hours until full
+		return (available_energy - soe_kwh) / instantaneous_power
+	return 8736
+
+def build_derived(devices):
+	# Per phase import, export and consumption from the grid meter, battery
+	# energy and time remaining, then whole site totals from those
+	derived = DerivedMetrics()
+	site = {"powers": [], "consumption": [], "production": [], "battery_energy": [], "battery_power": []}
+	for device_config in devices.values():
+		if not device_config["enabled"]:
+			continue
+		phase = device_config["inverter"]["phase"]
+		node = device_config["node_name"]
+		if device_config["data_source"] == "meter" and device_config["index"] == 1:
+			powers = [(node, "l1_power"), (node, "l2_power"), (node, "l3_power")]
+			derived.add(node, f"{phase}-IMPORT", powers, imported)
+			derived.add(node, f"{phase}-EXPORT", powers, exported)
+			# Everything added to the scaled power_ac, and the site totals the
+			# demand estimate is fed from, take the scaled grid power
+			derived.add(node, "grid_power", [(node, "power")], grid_power)
+			site["powers"].append((node, "grid_power"))
+			leader = devices.get(f"{phase}-LEADER")
+			if leader is not None and leader["enabled"]:
+				derived.add(node, f"{phase}-CONSUMPTION", [(leader["node_name"], "power_ac"), (node, "grid_power")], consumption)
+				site["consumption"].append((node, f"{phase}-CONSUMPTION"))
+		if device_config["data_source"] == "leader":
+			site["production"].append((node, "power_ac"))
+		if device_config["data_source"] == "battery":
+			derived.add(node, "soe_kwh", [(node, "soe"), (node, "available_energy")], soe_energy)
+			derived.add(node, "remaining_hours", [(node, "soe_kwh"), (node, "available_energy"), (node, "instantaneous_power")], remaining_hours)
+			site["battery_energy"].append((node, "soe_kwh"))
+			site["battery_power"].append((node, "instantaneous_power"))
+	if site["powers"]:
+		derived.add(SITE_NODE, "IMPORT", site["powers"], imported)
+		derived.add(SITE_NODE, "EXPORT", site["powers"], exported)
+	for key, inputs in (("CONSUMPTION", site["consumption"]), ("PRODUCTION", site["production"]), ("BATTERY-ENERGY", site["battery_energy"]), ("BATTERY-POWER", site["battery_power"])):
+		if inputs:
+			derived.add(SITE_NODE, key, inputs, total)
+	return derived
+
+derived = build_derived(devices)
+
+def build_pacers(devices):
+	if POLL_MAX_INTERVAL <= INTERVAL:
+		return {}
+	pacers = {}
+	for device_name, device_config in devices.items():
+		if not device_config["enabled"]:
+			continue
+		source = device_config["data_source"]
+		idle = {"status": IDLE_STATUS} if source == "leader" else None
+		pacers[device_name] = AdaptiveInterval(INTERVAL, POLL_MAX_INTERVAL, POLL_KEYS.get(source, ()), fast=POLL_FAST, flat=POLL_FLAT, idle=idle)
+	return pacers
+
+pacers = build_pacers(devices)
+
+def build_backoffs(devices):
+	return {device_name: Backoff(FAIL_BACKOFF, FAIL_BACKOFF_MAX) for device_name in devices}
+
+backoffs = build_backoffs(devices)
+
+# Last (stamp, reading) per node, for derived metrics across devices
+latest = {}
+
+def read_started():
+	if not read_stats["inflight"]:
+		read_stats["since"] = time.monotonic()
+	read_stats["inflight"] += 1
+
+def read_finished():
+	read_stats["reads"] += 1
+	read_stats["inflight"] -= 1
+	if not read_stats["inflight"]:
+		busy = time.monotonic() - read_stats["since"]
+		read_stats["busy"] += busy
+		metrics.observe("busy", busy)
+
+def read_totals():
+	# Read stats since the last call, counting a stretch still in flight up to
+	# now. Serial is the time the endpoints spent on the reads themselves, busy
+	# the wall time any read was waiting or in flight
+	if read_stats["inflight"]:
+		now = time.monotonic()
+		read_stats["busy"] += now - read_stats["since"]
+		metrics.observe("busy", now - read_stats["since"])
+		read_stats["since"] = now
+	spent = io_time()
+	totals = {"reads": read_stats["reads"], "serial": spent - read_stats["io"], "busy": read_stats["busy"]}
+	read_stats.update({"reads": 0, "busy": 0.0, "io": spent})
+	return totals
+
+async def read_with_deadline(device_config, source, deadline):
+	# The worker thread keeps the deadline itself, giving up on it here would
+	# leave it holding the endpoint's lock; wait_for only catches one that
+	# does not stop
+	read_started()
 	try:
-		task = asyncio.create_task(asyncio.wait_for(get_device_data(session, 0, device_config["data_source"]), timeout=READTIMEOUT))
-		values = await task
-		#print(f"{device_config['data_source']} {datetime.now()}")
-		processed_data = {}
-		for k, v in values.items():
-			if (isinstance(v, int) or isinstance(v, float)) and "_scale" not in k:
-				k_split = k.split("_")
-				scale = 0
-				if f"{k_split[len(k_split) - 1]}_scale" in values:
-					scale = values[f"{k_split[len(k_split) - 1]}_scale"]
-				elif f"{k}_scale" in values:
-					scale = values[f"{k}_scale"]
-				processed_data.update({k: float(v * (10 ** scale))})
-				if device_config["data_source"] == "meter":
-					if (isinstance(v, int) or isinstance(v, float)):
-						if k == "l1_power" or k == "l2_power" or k == "l3_power":
-							processed_data.update({k: float(v * (-1))})
-				if device_config["data_source"] == "battery1" or device_config["data_source"] == "battery2":
-					if (isinstance(v, int) or isinstance(v, float)):
-						if k != "instantaneous_power":
-							if v < 0:
-								v = 0
-								processed_data.update({k: float(v)})
-		if device_config["data_source"] == "meter":
-			sum_of_powers = sum(v for v in [processed_data.get('l1_power'), processed_data.get('l2_power'), processed_data.get('l3_power')] if isinstance(v, (int, float)))
-			import_data, export_data = (sum_of_powers, 0) if sum_of_powers > 0 else (0, sum_of_powers)
-			data = {f"{PHASE_COLOUR}-IMPORT": import_data, f"{PHASE_COLOUR}-EXPORT": export_data, f"{PHASE_COLOUR}-CONSUMPTION": 0}
-			processed_data.update(data)
-
-		if device_config["data_source"] == "battery1" or device_config["data_source"] == "battery2":
-			if 'soe' in processed_data:
-				if 'available_energy' in processed_data:
-					soe_kwh = (processed_data['soe']/100) * processed_data['available_energy']
-					data = {"soe_kwh": soe_kwh}
-					processed_data.update(data)
-					if 'instantaneous_power' in processed_data:
-						instantaneous_power = processed_data['instantaneous_power']
-						if instantaneous_power < 0: #discharging when below 0
-							remaining_hours = (soe_kwh / instantaneous_power)
-							data = {"remaining_hours": remaining_hours}
-							#print(f"Hours until empty: {remaining_hours}")
-							processed_data.update(data)
-						if instantaneous_power > 0: #charging when above 0
-							remaining_hours = ((processed_data['available_energy'] - soe_kwh) / instantaneous_power)
-							data = {"remaining_hours": remaining_hours}
-							#print(f"Hours until full: {remaining_hours}")
-							processed_data.update(data)
-						if instantaneous_power == 0:
-						#else:
-							data = {"remaining_hours": 8736}
-							processed_data.update(data)
-		if device_config["read_storage"]:
-			if device_config["storage"]:
-				storagetask = asyncio.create_task(get_device_data(session, 0, device_config["storage_source"]))
-				storagevalues = await storagetask
-				processed_data.update(storagevalues)
+		with metrics.timer("read", device=device_config["node_name"], source=source):
+			return await asyncio.wait_for(get_device_data(device_config, source, time.monotonic() + deadline), timeout=deadline + DEADLINE_GRACE)
+	finally:
+		read_finished()
+
+async def process_device_data(device_name, device_config):
+	try:
+		stamp, values = await read_with_deadline(device_config, device_config["data_source"], device_config["deadline"])
+		with metrics.timer("decode", device=device_config["node_name"]):
+			processed_data = decode(decode_plans, device_config["data_source"], values, key=device_name)
+		# Storage shares the leader's connection, so it is read after it
+		# with its own deadline starting then
+		if device_config["read_storage"] and device_config["storage"]:
+			storagestamp, storagevalues = await read_with_deadline(device_config, device_config["storage_source"], device_config["storage_deadline"])
+			processed_data.update(storagevalues)
 
 		node_name = device_config["node_name"]
-		data = json.dumps(processed_data, default=float)
-		return node_name, data
+		return stamp, node_name, processed_data
 
 	except ValueError:
 		pass
 
-	except asyncio.TimeoutError:
-		print(f"{device_name} Timeout error occurred!")
-		await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"{device_name} Timeout error occurred!")
+def print_stats(post_queue):
+	reads = read_totals()
+	if reads["reads"]:
+		serial_ms = reads["serial"] * 1000
+		busy_ms = reads["busy"] * 1000
+		print(f"Read time {busy_ms:.0f} ms (serial reads {serial_ms:.0f} ms, saved {serial_ms - busy_ms:.0f} ms) over {reads['reads']} reads")
+	if tickers:
+		print("Scheduler: " + ", ".join(f"{device_name} {ticker.stats['ticks']} ticks {ticker.stats['overruns']} overruns {ticker.stats['missed']} missed late <= {ticker.stats['lateness_max_ms']:g} ms" for device_name, ticker in tickers.items()))
+	for endpoint, stats in connection_stats().items():
+		print(f"Connection {endpoint}: {stats}")
+	print(f"Post queue: {post_queue.metrics()}")
+	print(f"Publish filter: {publish_filter.stats}")
+	print(f"Derived: {derived.stats}")
+	if pacers:
+		print("Polling: " + ", ".join(f"{device_name} {pacer.interval:g}s" for device_name, pacer in pacers.items()))
+	failing = {device_name: backoff.failures for device_name, backoff in backoffs.items() if backoff.failures}
+	if failing:
+		print(f"Backed off: {failing}")
+	if aggregator is not None:
+		print(f"Aggregator: {aggregator.stats}")
+	if demand_estimator is not None:
+		print(f"Demand: {demand_estimator.stats} {demand_estimator.estimate() if demand_estimator.last is not None else ''}")
+	print(f"Health: {health.stats}")
+	print("Stages: " + ", ".join(f"{stage} mean {mean * 1000:.1f} ms p99 <= {p99 * 1000:.0f} ms" for stage, (count, mean, p99) in metrics.summary().items()))
 
-async def update_info_and_display(session):
-	tasks = []
-	enabled_devices = sum(1 for device_config in devices.values() if device_config["enabled"])
-	#print(f"Number of enabled devices: {enabled_devices}")
-	successful_tasks = 0
-	for device_name, device_config in devices.items():
-		if device_config["enabled"]:
-			task = asyncio.create_task(process_device_data(device_name, device_config, session))
-			tasks.append(task)
-			result = await task
-			if result is not None:
-				successful_tasks += 1
-	#print(f"Number of successful tasks: {successful_tasks}")
-	if successful_tasks == enabled_devices:
-		for task in asyncio.as_completed(tasks):
-			result = await task
-			if result is not None:
-				node_name, data = result
-				#node_name, data = await task  # Get the node_name value from the completed task
-				task = asyncio.create_task(post_to_emoncms(session, node_name, data))
+def report_error(device_name, e):
+	metrics.error("device", e, device=device_name)
+	if "Modbus Error" in str(e) and "Connection unexpectedly closed" in str(e):
+		health.error(f"{device_name}: Error updating info: {e}")
+	elif "Server disconnected" in str(e):
+		pass
 	else:
-		print(f"Successful tasks ({successful_tasks}) does not match number of enabled devices ({enabled_devices})")
-		await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Successful tasks ({successful_tasks}) does not match number of enabled devices ({enabled_devices})")
-		print("NOT POSTING")
-	try:
-		await asyncio.gather(*tasks)
-		await health_check(session, HEALTHCHECKS_IO_URL, f"Success")
+		print(f"{device_name}: Error updating info: {e}")
+		health.error(f"{device_name}: Error updating info: {e}")
 
-	except asyncio.TimeoutError:
+def publish(post_queue, row):
+	# Site totals take the other devices' last readings, as long as they are
+	# recent enough
+	stamp, node, data = row
+	latest[node] = (stamp, data)
+	oldest = wall_time() - HELD_MAX_AGE
+	held = {node: data for node, (ts, data) in latest.items() if ts is not None and ts >= oldest}
+	rows = derived.rows([row], held=held)
+	estimate = None
+	if demand_estimator is not None:
+		for ts, node, data in rows:
+			if node == SITE_NODE and "IMPORT" in data:
+				demand_estimator.add(ts, data["IMPORT"])
+				estimate = demand_estimator.row(DEMAND_NODE, ts)
+	if aggregator is not None:
+		rows = aggregator.rows(rows)
+	# Projections go out as they are, not averaged over PUBLISH_WINDOW
+	if estimate is not None:
+		rows.append(estimate)
+	post_queue.put(publish_filter.rows(rows))
+
+async def poll_device(device_name, device_config, post_queue):
+	# One read of one device, published as soon as it is in
+	backoff = backoffs[device_name]
+	result = None
+	try:
+		# A read that ran out of time is not retried, the inverter is slow
+		# and the other devices behind it are waiting their turn
+		for attempt in range(DEVICE_RETRIES + 1):
+			result = await process_device_data(device_name, device_config)
+			if result is not None:
+				break
+	except (asyncio.TimeoutError, TimeoutError):
 		print(f"{device_name} Timeout error occurred!")
-		await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"{device_name} Timeout error occurred!")
+		health.error(f"{device_name} Timeout error occurred!")
+	except ConnectionError as e:
+		print(e)
 	except Exception as e:
-		if "Modbus Error" in str(e) and "Connection unexpectedly closed" in str(e):
-			#pass  # Ignore this specific exception
-			await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Error updating info: {e}")
-		elif "Server disconnected" in str(e):
-			pass
-		else:
-			print(f"Error updating info: {e}")
-			await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Error updating info: {e}")
+		report_error(device_name, e)
+	if result is None:
+		delay = backoff.failure()
+		print(f"{device_name}: read failed {backoff.failures} times, next try in {delay:g}s")
+		return None
+	backoff.success()
+	pacer = pacers.get(device_name)
+	if pacer is not None:
+		pacer.update(result[2])
+	publish(post_queue, result)
+	health.success()
+	return result
+
+def is_due(device_name, now):
+	pacer = pacers.get(device_name)
+	return not backoffs[device_name].until(now) and (pacer is None or pacer.due(now))
+
+def wait_time(device_name, now):
+	# Seconds until the device is next due
+	pacer = pacers.get(device_name)
+	return max(backoffs[device_name].until(now), pacer.until(now) if pacer is not None else 0.0)
+
+async def device_loop(device_name, device_config, post_queue):
+	# A device's own pipeline: ticker, pacing, deadline, retries and backoff
+	ticker = tickers[device_name] = Ticker(INTERVAL)
+	while True:
+		await ticker.wait()
+		if INTERVAL:
+			metrics.observe("tick", ticker.stats["lateness_last_ms"] / 1000, device=device_config["node_name"])
+		start = time.monotonic()
+		if not is_due(device_name, start):
+			# Skip the tick rather than sleeping past the next one, so a paced
+			# or backed off device stays on the wall clock ticks. Free running
+			# there are no ticks to keep, so wait out the time instead of spinning
+			if not INTERVAL:
+				await asyncio.sleep(wait_time(device_name, start))
+			continue
+		try:
+			await poll_device(device_name, device_config, post_queue)
+		except Exception as e:
+			report_error(device_name, e)
+		metrics.observe("cycle", time.monotonic() - start, device=device_config["node_name"])
+
+async def stats_loop(post_queue):
+	while True:
+		await asyncio.sleep(STATS_EVERY * max(INTERVAL, 1))
+		print_stats(post_queue)
+
+async def demand_seed_loop():
+	# The margin is measured from the month's real peak, not only the windows
+	# this collector happened to see close
+	while True:
+		demand_estimator.seed_from(DEMAND_SEED_PATH)
+		await asyncio.sleep(DEMAND_SEED_EVERY)
 
+def rediscover_batteries():
+	print("Rediscovering batteries")
+	rediscover()
 
 async def main():
 	print("Starting up...")
-	async with aiohttp.ClientSession() as session:
-		await update_info_and_display(session)
+	# kill -HUP after adding or removing a battery
+	asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, rediscover_batteries)
+	async with metrics, health, Outputs(sinks, maxsize=POST_QUEUE_SIZE, workers=POST_WORKERS, policy=POST_OVERLOAD, on_error=post_error) as outputs:
+		post_queue = Coalescer(outputs, linger=POST_LINGER)
+		tasks = [asyncio.create_task(device_loop(device_name, device_config, post_queue)) for device_name, device_config in devices.items() if device_config["enabled"]]
+		tasks.append(asyncio.create_task(stats_loop(post_queue)))
+		if demand_estimator is not None and DEMAND_SEED_PATH:
+			tasks.append(asyncio.create_task(demand_seed_loop()))
 		print("Running.")
-		while True:
-			try:
-				await asyncio.sleep(INTERVAL)
-				await update_info_and_display(session)
-			except asyncio.TimeoutError:
-				print(f"Timeout error occurred!")
-				await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Timeout error occurred in main")
-			except Exception as e:
-				if "Modbus Error" in str(e) and "Connection unexpectedly closed" in str(e):
-					await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Error in main: {e}")
-					#pass  # Ignore this specific exception
-				elif "name 'session' is not defined" in str(e):
-					#await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Error in main: {e}")
-					pass  # Ignore this specific exception
-				elif "Server disconnected" in str(e):
-					pass
-				else:
-					print(f"Error in main: {e}")
-					await health_check(session, HEALTHCHECKS_IO_URL+"/log", f"Error in main: {e}")
+		try:
+			await asyncio.gather(*tasks)
+		finally:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+			post_queue.flush()
 
 if __name__ == "__main__":
 	asyncio.run(main())